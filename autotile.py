@@ -0,0 +1,149 @@
+# Wall autotiling. Each wall's character depends on which of its four
+# neighbours are walls (or doors), so it's looked up from a 4-bit mask.
+
+# Python imports
+import platform
+
+# Our imports
+from mapgrid import MapGrid
+
+# Neighbour bits
+UP = 1
+DOWN = 2
+LEFT = 4
+RIGHT = 8
+
+# The wall pieces for each character set, by name
+CHARSETS = {
+    'ascii': {
+        'UpDown': '|',
+        'LeftRight': '-',
+        'UpLeft': '-',
+        'UpRight': '-',
+        'DownLeft': '-',
+        'DownRight': '-',
+        'DownLeftRight': '-',
+        'UpLeftRight': '-',
+        'LeftUpDown': '|',
+        'RightUpDown': '|',
+        'UpDownLeftRight': '|',
+    },
+    # Box drawing characters from code page 437, for the Windows console
+    'cp437': {
+        'UpDown': chr(0xB3),
+        'LeftRight': chr(0xC4),
+        'UpLeft': chr(0xD9),
+        'UpRight': chr(0xC0),
+        'DownLeft': chr(0xBF),
+        'DownRight': chr(0xDA),
+        'DownLeftRight': chr(0xC2),
+        'UpLeftRight': chr(0xC1),
+        'LeftUpDown': chr(0xB4),
+        'RightUpDown': chr(0xC3),
+        'UpDownLeftRight': chr(0xC5),
+    },
+}
+
+def charsetFor(system):
+    """The character set to use on the given platform.system()"""
+    if system == 'Windows':
+        return 'cp437'
+    return 'ascii'
+
+def pieceFor(mask):
+    """Name of the wall piece for a neighbour mask. Later rules win, so
+    corners beat straights and junctions beat corners."""
+    up = mask & UP
+    down = mask & DOWN
+    left = mask & LEFT
+    right = mask & RIGHT
+    piece = 'LeftRight' if (left or right) else 'UpDown'
+    if up and left:
+        piece = 'UpLeft'
+    if up and right:
+        piece = 'UpRight'
+    if down and left:
+        piece = 'DownLeft'
+    if down and right:
+        piece = 'DownRight'
+    if down and left and right:
+        piece = 'DownLeftRight'
+    if up and left and right:
+        piece = 'UpLeftRight'
+    if left and up and down:
+        piece = 'LeftUpDown'
+    if right and up and down:
+        piece = 'RightUpDown'
+    if right and up and down and left:
+        piece = 'UpDownLeftRight'
+    return piece
+
+def glyphTable(charset):
+    """The wall character for each of the 16 neighbour masks"""
+    pieces = CHARSETS[charset]
+    return [pieces[pieceFor(mask)] for mask in range(16)]
+
+class WallTiler(object):
+    """Gives every wall on the map the right character for its neighbours.
+    Once it's tiled the whole map it keeps watching the grid, and re-tiles
+    just the neighbourhood of any wall or door that's added or removed.
+    House number signs are left alone."""
+    def __init__(self, game, charset=None):
+        super(WallTiler, self).__init__()
+        self.game = game
+        if charset is None:
+            charset = charsetFor(platform.system())
+        self.table = glyphTable(charset)
+        self.watching = False
+
+    def mask(self, index):
+        """The neighbour mask for the cell at the flat index"""
+        grid = self.game.grid
+        terrain = grid.terrain
+        connects = MapGrid.WALL | MapGrid.DOOR
+        (y, x) = divmod(index, grid.width)
+        mask = 0
+        if y > 0 and terrain[index - grid.width] & connects:
+            mask |= UP
+        if y < grid.height - 1 and terrain[index + grid.width] & connects:
+            mask |= DOWN
+        if x > 0 and terrain[index - 1] & connects:
+            mask |= LEFT
+        if x < grid.width - 1 and terrain[index + 1] & connects:
+            mask |= RIGHT
+        return mask
+
+    def tile(self, index):
+        """Set the character of the wall at index, if there is one. Returns
+        True if it changed."""
+        grid = self.game.grid
+        if not grid.terrain[index] & MapGrid.WALL:
+            return False
+        (character, colour) = grid.glyphs[grid.wallGlyphs[index]]
+        if character.isdigit():
+            return False
+        glyph = grid.glyphFor(self.table[self.mask(index)], colour)
+        if glyph == grid.wallGlyphs[index]:
+            return False
+        grid.wallGlyphs[index] = glyph
+        return True
+
+    def tileAll(self):
+        """Tile every wall on the map, then keep them up to date"""
+        grid = self.game.grid
+        for (index, terrain) in enumerate(grid.terrain):
+            if terrain & MapGrid.WALL:
+                self.tile(index)
+        if not self.watching:
+            grid.terrainWatchers.append(self.cellChanged)
+            self.watching = True
+
+    def cellChanged(self, index):
+        """Re-tile a cell that changed, and its neighbours"""
+        grid = self.game.grid
+        (y, x) = divmod(index, grid.width)
+        self.tile(index)
+        self.game.dirtyCells.markIndex(index)
+        for (nY, nX) in ((y - 1, x), (y + 1, x), (y, x - 1), (y, x + 1)):
+            if grid.inBounds(nY, nX) and self.tile(grid.index(nY, nX)):
+                self.game.dirtyCells.mark(nY, nX)
@@ -0,0 +1,110 @@
+# Renderer backends. The game only ever talks to windows and pads through
+# these, so it can run in a terminal or entirely in memory.
+
+# External imports
+import curses
+
+# Our imports
+from constants import Constants
+
+class CursesBackend(object):
+    """Draws to the terminal using curses"""
+    def newWindow(self, height, width):
+        return curses.newwin(height, width)
+
+    def newPad(self, height, width):
+        return curses.newpad(height, width)
+
+    def doupdate(self):
+        curses.doupdate()
+
+    def initColours(self):
+        """Set-up the colours we'll be using"""
+        curses.start_color()
+        curses.init_pair(1, curses.COLOR_RED, curses.COLOR_BLACK)
+        curses.init_pair(2, curses.COLOR_YELLOW, curses.COLOR_BLACK)
+        curses.init_pair(3, curses.COLOR_GREEN, curses.COLOR_BLACK)
+        curses.init_pair(5, curses.COLOR_BLUE, curses.COLOR_BLACK)
+        Constants.initColours()
+
+class HeadlessWindow(object):
+    """An in-memory stand-in for a curses window or pad. Keeps the
+    characters and attributes written to it, and takes input from a queue
+    of key codes instead of the keyboard."""
+    def __init__(self, height, width):
+        super(HeadlessWindow, self).__init__()
+        self.height = height
+        self.width = width
+        self.cursorY = 0
+        self.cursorX = 0
+        self.keys = []
+        self.calls = 0 # addstr calls, for measuring the renderer
+        self.erase()
+
+    def erase(self):
+        self.characters = [[' '] * self.width for _ in range(self.height)]
+        self.attributes = [[0] * self.width for _ in range(self.height)]
+
+    def addstr(self, *args):
+        """Same signatures as curses: ([y, x,] string [, attribute])"""
+        self.calls += 1
+        if len(args) >= 3:
+            (self.cursorY, self.cursorX) = (args[0], args[1])
+            args = args[2:]
+        string = args[0]
+        attribute = args[1] if len(args) > 1 else 0
+        for character in string:
+            if character == '\n':
+                (self.cursorY, self.cursorX) = (self.cursorY + 1, 0)
+                continue
+            if 0 <= self.cursorY < self.height and 0 <= self.cursorX < self.width:
+                self.characters[self.cursorY][self.cursorX] = character
+                self.attributes[self.cursorY][self.cursorX] = attribute or 0
+            self.cursorX += 1
+            if self.cursorX >= self.width:
+                (self.cursorY, self.cursorX) = (self.cursorY + 1, 0)
+
+    def move(self, y, x):
+        (self.cursorY, self.cursorX) = (y, x)
+
+    def getyx(self):
+        return (self.cursorY, self.cursorX)
+
+    def getmaxyx(self):
+        return (self.height, self.width)
+
+    def getch(self):
+        """Next queued key, or -1 like a non-blocking curses window"""
+        if self.keys:
+            return self.keys.pop(0)
+        return -1
+
+    def bkgd(self, *args):
+        pass
+
+    def noutrefresh(self, *args):
+        pass
+
+    def line(self, y):
+        """The text on row y, handy for tests and soak runs"""
+        return ''.join(self.characters[y])
+
+class HeadlessBackend(object):
+    """Runs the game without a terminal, everything drawn in to memory"""
+    def newWindow(self, height, width):
+        return HeadlessWindow(height, width)
+
+    def newPad(self, height, width):
+        return HeadlessWindow(height, width)
+
+    def doupdate(self):
+        pass
+
+    def initColours(self):
+        """No curses colour pairs here, so give each colour a distinct
+        attribute value of its own"""
+        Constants.COLOUR_WHITE = 0
+        Constants.COLOUR_RED = 1
+        Constants.COLOUR_YELLOW = 2
+        Constants.COLOUR_GREEN = 3
+        Constants.COLOUR_BLUE = 5
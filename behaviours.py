@@ -1,10 +1,8 @@
 # NPC Behaviour classes!
 
-# Python imports
-import random
-
 # Our imports
 from enums import Direction
+import rng
 
 class Behaviour(object):
     """The base class for NPC behaviours. Behaviours control NPC behaviour
@@ -24,7 +22,7 @@ class DefaultBehaviour(Behaviour):
     
     def execute(self):
         """Move randomly!"""
-        self.npc.attemptMove(random.randint(1,5))
+        self.npc.attemptMove(rng.ai.randint(1,5))
 
 class Dead(Behaviour):
     """Do nothing. Seriously, what do you expect a corpse to do?"""
@@ -45,17 +43,22 @@ class VisitingHouse(Behaviour):
         """Move randomly, but don't leave the house"""
         # Occasionally decide to move to a new room, otherwise just
         # womble about randomly without leaving.
-        moveRoom = random.randint(0, 25) == 24
+        moveRoom = rng.ai.randint(0, 25) == 24
         npc = self.npc
         house = self.house
         if moveRoom:
-            room = random.choice(house.rooms)
-            randomX = random.randint(1, room.width - 1)
-            randomY = random.randint(1, room.height - 1)
-            npc.path = npc.findPath(house.absoluteY + room.y + randomY,
-                                    house.absoluteX + room.x + randomX)
+            room = rng.ai.choice(house.rooms)
+            randomX = rng.ai.randint(1, room.width - 1)
+            randomY = rng.ai.randint(1, room.height - 1)
+            goal = (house.absoluteY + room.y + randomY,
+                    house.absoluteX + room.x + randomX)
+            # The house knows its own way around, the pathfinder's only
+            # needed if we've somehow ended up outside it
+            npc.path = house.pathInRoom(room, (npc.y, npc.x), goal)
+            if npc.path is None:
+                npc.path = npc.findPath(goal[0], goal[1])
         else:
-            randomDirection = random.randint(1,5)
+            randomDirection = rng.ai.randint(1,5)
             while True:
                 if randomDirection is not Direction.DOWN:
                     break
@@ -63,7 +66,7 @@ class VisitingHouse(Behaviour):
                     absoluteFrontDoorPos = (house.absoluteY + house.frontDoorPos[0],
                                             house.absoluteX + house.frontDoorPos[1])
                     if (npc.y + 1, npc.x) == absoluteFrontDoorPos:
-                        randomDirection = random.randint(1,5)
+                        randomDirection = rng.ai.randint(1,5)
                     else:
                         break
             npc.attemptMove(randomDirection)
@@ -0,0 +1,104 @@
+# Runs the benchmark suite without a terminal and writes the results as
+# JSON. Given a baseline from an earlier run, it compares the two and exits
+# with a failure if anything got slower than the tolerance allows. It also
+# fails if a saved game didn't carry on the same as the one it came from.
+#
+#     python benchmarks/run.py --output baseline.json
+#     python benchmarks/run.py --compare baseline.json
+
+# Python imports
+import argparse, json, os, platform, sys, time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+# Our imports
+import suite, profiler
+
+def runSuite(names, repeat):
+    """Run the named benchmarks (all of them if there are no names),
+    returning their results by name"""
+    profiler.current.enabled = False # It'd only get in the way
+    results = {}
+    for (name, benchmark) in suite.BENCHMARKS:
+        if names and name not in names:
+            continue
+        start = time.time()
+        result = benchmark(repeat)
+        if all(isinstance(value, dict) for value in result.values()):
+            results.update(result)
+        else:
+            results[name] = result
+        print("{} took {:.1f}s".format(name, time.time() - start), file=sys.stderr)
+    return results
+
+def compare(results, baseline, tolerance):
+    """Print how every result compares with the baseline. Returns the
+    timings that got slower by more than the tolerance."""
+    regressions = []
+    for (name, result) in sorted(results.items()):
+        old = baseline.get(name)
+        if old is None:
+            print("{:<16} new".format(name))
+            continue
+        for (key, value) in sorted(result.items()):
+            if key not in old:
+                continue
+            if key.endswith('Ms'):
+                ratio = value / old[key] if old[key] else float('inf')
+                slower = ratio > 1 + tolerance
+                if slower:
+                    regressions.append((name, key, ratio))
+                print("{:<16} {:<22} {:10.3f} -> {:10.3f}  {:6.2f}x{}".format(
+                    name, key, old[key], value, ratio,
+                    "  SLOWER" if slower else ""))
+            elif value != old[key]:
+                print("{:<16} {:<22} {} -> {} (the work done changed)".format(
+                    name, key, old[key], value))
+    return regressions
+
+def main():
+    parser = argparse.ArgumentParser(description="Rogue Detective benchmarks")
+    parser.add_argument('names', nargs='*', metavar='NAME',
+                        help="benchmarks to run: " +
+                             ', '.join(name for (name, _) in suite.BENCHMARKS))
+    parser.add_argument('--repeat', type=int, default=3,
+                        help="runs of each benchmark, the fastest counts")
+    parser.add_argument('--output', metavar='FILE',
+                        help="write the results to FILE as well as stdout")
+    parser.add_argument('--compare', metavar='FILE',
+                        help="compare with the results in FILE")
+    parser.add_argument('--tolerance', type=float, default=0.25,
+                        help="how much slower than the baseline a timing can "
+                             "get before it fails, as a fraction")
+    args = parser.parse_args()
+
+    report = {
+        'python': platform.python_version(),
+        'platform': platform.platform(),
+        'repeat': args.repeat,
+        'results': runSuite(args.names, args.repeat),
+    }
+    text = json.dumps(report, indent=2, sort_keys=True)
+    if args.output is not None:
+        with open(args.output, 'w') as outputFile:
+            outputFile.write(text + '\n')
+    diverged = [name for (name, result) in sorted(report['results'].items())
+                if result.get('identical') is False]
+    for name in diverged:
+        print("{} didn't carry on the same after loading".format(name),
+              file=sys.stderr)
+    if args.compare is None:
+        print(text)
+        return 1 if diverged else 0
+
+    with open(args.compare) as baselineFile:
+        baseline = json.load(baselineFile)['results']
+    regressions = compare(report['results'], baseline, args.tolerance)
+    if regressions:
+        print("{} timing(s) more than {:.0%} slower than the baseline".format(
+            len(regressions), args.tolerance))
+        return 1
+    return 1 if diverged else 0
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,293 @@
+# The benchmarks themselves. Each one builds what it needs from fixed seeds
+# on the headless backend, times the part it's interested in, and returns
+# a dict of results. Timings are in milliseconds and their names end in Ms,
+# everything else describes the work done, so a change there means the
+# benchmark isn't measuring the same thing any more.
+
+# Python imports
+import os, random, tempfile, time
+from collections import deque
+
+# Our imports
+from constants import Constants
+from backends import HeadlessBackend
+from game import Game
+from mapgrid import MapGrid
+from entity import NPC
+from plan import Plan
+from town import layoutHouse
+from replay import stateDigest
+import fov, rng, savegame
+
+WORLD_SEED = 1 # The world every benchmark but generation runs in
+GENERATION_SEEDS = (1, 2, 3, 4, 5)
+LAYOUT_SEEDS = range(200)
+CORPUS_SEED = 7 # Picks the start/goal pairs and viewpoints
+PATH_PAIRS = 200
+FOV_POSITIONS = 200
+DRAW_FRAMES = 500
+TICK_TURNS = 1000
+TICK_NPC_COUNTS = (25, 50, 100, 200) # The world starts with 23
+SAVE_TURN = 481 # 10:00, when plans fire and routes are being waited on
+SAVE_CHECK_TURNS = 300
+SAVE_CHUNK_SIZE = 32
+
+def bestOf(repeat, function):
+    """Runs function repeat times, returning the fastest time in
+    milliseconds and whatever the last run returned"""
+    best = None
+    for _ in range(repeat):
+        start = time.perf_counter()
+        result = function()
+        elapsed = (time.perf_counter() - start) * 1000
+        best = elapsed if best is None else min(best, elapsed)
+    return (best, result)
+
+def newGame(seed):
+    """A freshly generated game on the headless backend"""
+    rng.seed(seed)
+    backend = HeadlessBackend()
+    backend.initColours()
+    game = Game(backend.newWindow(Constants.YRES, Constants.XRES), backend)
+    game.initialiseWalls()
+    return game
+
+def openCells(game, count, seed):
+    """count cells that aren't walls, fences or doors and can be walked to
+    from where the player starts, picked with their own stream so they're
+    the same every run"""
+    grid = game.grid
+    blocking = MapGrid.WALL | MapGrid.FENCE
+    start = grid.index(game.player.y, game.player.x)
+    reached = set([start])
+    queue = deque([start])
+    while queue:
+        index = queue.popleft()
+        (y, x) = divmod(index, grid.width)
+        for (nY, nX) in ((y - 1, x), (y + 1, x), (y, x - 1), (y, x + 1)):
+            neighbour = nY * grid.width + nX
+            if (grid.inBounds(nY, nX) and neighbour not in reached and
+                not grid.terrain[neighbour] & blocking):
+                reached.add(neighbour)
+                queue.append(neighbour)
+    cells = [divmod(index, grid.width) for index in sorted(reached)
+             if not grid.terrain[index] & MapGrid.DOOR]
+    return random.Random(seed).sample(cells, count)
+
+def generation(repeat):
+    """World generation, towns, murder and plans, over a few seeds"""
+    def generate():
+        for seed in GENERATION_SEEDS:
+            game = newGame(seed)
+            game.pathRequests.close()
+        return game
+    (elapsed, game) = bestOf(repeat, generate)
+    return {
+        'worldMs': elapsed / len(GENERATION_SEEDS),
+        'worlds': len(GENERATION_SEEDS),
+    }
+
+def layout(repeat):
+    """House layouts, and how often they have to be retried"""
+    def layOut():
+        return [layoutHouse(seed, 1) for seed in LAYOUT_SEEDS]
+    (elapsed, layouts) = bestOf(repeat, layOut)
+    houses = float(len(layouts))
+    return {
+        'layoutMs': elapsed / houses,
+        'houses': len(layouts),
+        'attemptsPerHouse': sum(layout['layoutAttempts'] for layout in layouts) / houses,
+        'restartsPerHouse': sum(layout['partitionRestarts'] for layout in layouts) / houses,
+        'doorsPunchedPerHouse': sum(layout['doorsPunched'] for layout in layouts) / houses,
+    }
+
+def pathfinding(repeat):
+    """NPC.findPath over a fixed corpus of start and goal pairs, first with
+    an empty path cache and then again with everything cached"""
+    game = newGame(WORLD_SEED)
+    npc = game.npcs[0]
+    cells = openCells(game, PATH_PAIRS * 2, CORPUS_SEED)
+    pairs = list(zip(cells[0::2], cells[1::2]))
+    cache = game.pathFinder.cache
+
+    def findAll():
+        paths = []
+        for (start, goal) in pairs:
+            npc.setPosition(start[0], start[1])
+            paths.append(npc.findPath(goal[0], goal[1]))
+        return paths
+    def cold():
+        for key in list(cache.paths):
+            cache.discard(key)
+        return findAll()
+
+    (coldElapsed, paths) = bestOf(repeat, cold)
+    (cachedElapsed, _) = bestOf(repeat, findAll)
+    game.pathRequests.close()
+    found = [path for path in paths if path]
+    return {
+        'coldMs': coldElapsed / len(pairs),
+        'cachedMs': cachedElapsed / len(pairs),
+        'pairs': len(pairs),
+        'found': len(found),
+        'totalSteps': sum(len(path) for path in found),
+    }
+
+def fieldOfView(repeat):
+    """Player.generateFov from sampled viewpoints, nothing cached, with each
+    backend there is"""
+    game = newGame(WORLD_SEED)
+    player = game.player
+    positions = openCells(game, FOV_POSITIONS, CORPUS_SEED)
+    backends = ['python'] + (['numpy'] if fov.numpy is not None else [])
+    results = {'positions': len(positions)}
+    original = Constants.FOV_BACKEND
+    try:
+        for backend in backends:
+            Constants.FOV_BACKEND = backend
+            def look():
+                lit = 0
+                for (y, x) in positions:
+                    player.fov.cache.clear()
+                    player.setPosition(y, x)
+                    player.generateFov()
+                    lit += len(player.fov.litCells)
+                return lit
+            (elapsed, lit) = bestOf(repeat, look)
+            results[backend + 'Ms'] = elapsed / len(positions)
+            results['cellsLit'] = lit
+    finally:
+        Constants.FOV_BACKEND = original
+    game.pathRequests.close()
+    return results
+
+def draw(repeat):
+    """Game.draw on the headless pad, the first full paint and then frames
+    with NPCs moving about between them"""
+    game = newGame(WORLD_SEED)
+    def bake():
+        game.mapRenderer.baked = False
+        game.draw()
+    (bakeElapsed, _) = bestOf(repeat, bake)
+
+    frames = 0.0
+    for _ in range(DRAW_FRAMES):
+        game.logic()
+        start = time.perf_counter()
+        game.draw()
+        frames += time.perf_counter() - start
+    game.pathRequests.close()
+    return {
+        'bakeMs': bakeElapsed,
+        'frameMs': frames * 1000 / DRAW_FRAMES,
+        'frames': DRAW_FRAMES,
+    }
+
+def addWanderers(game, count):
+    """Extra NPCs out and about, each visiting houses through the day the
+    way villagers do"""
+    stream = random.Random(CORPUS_SEED)
+    for (y, x) in openCells(game, count, CORPUS_SEED):
+        npc = NPC(game, y, x)
+        game.npcs.append(npc)
+        for _ in range(5):
+            square = stream.choice(game.squares)
+            npc.plan.addPlanEntry(stream.randint(0, 8) + 8, 0,
+                                  Plan.VisitNeighbour(npc, square))
+
+def ticks(repeat):
+    """Game.logic for a good part of a day, with more and more people"""
+    results = {}
+    for count in TICK_NPC_COUNTS:
+        def run():
+            game = newGame(WORLD_SEED)
+            if count > len(game.npcs):
+                addWanderers(game, count - len(game.npcs))
+            start = time.perf_counter()
+            for _ in range(TICK_TURNS):
+                game.logic()
+            elapsed = time.perf_counter() - start
+            game.pathRequests.close()
+            return (elapsed, game)
+        best = None
+        for _ in range(repeat):
+            (elapsed, game) = run()
+            best = elapsed if best is None else min(best, elapsed)
+        results['ticks.{}'.format(count)] = {
+            'tickMs': best * 1000 / TICK_TURNS,
+            'npcs': len(game.npcs),
+            'turns': TICK_TURNS,
+            'clock': '{:02d}:{:02d}'.format(game.hour, game.minute),
+        }
+    return results
+
+def roundTrip(repeat):
+    """Saving and loading at the top of an hour, with NPCs waiting on
+    routes, and checking the loaded game carries on exactly as the original
+    did"""
+    game = newGame(WORLD_SEED)
+    while game.turn < SAVE_TURN:
+        game.logic()
+    requests = game.pathRequests
+    pending = len(requests.waiting) + len(requests.running) + len(requests.ready)
+    (handle, path) = tempfile.mkstemp(suffix='.sav')
+    os.close(handle)
+    try:
+        (saveElapsed, _) = bestOf(repeat, lambda: savegame.saveGame(game, path))
+        digests = []
+        for _ in range(SAVE_CHECK_TURNS):
+            game.logic()
+            digests.append(stateDigest(game))
+        game.pathRequests.close()
+
+        backend = HeadlessBackend()
+        backend.initColours()
+        loads = []
+        def load():
+            # Only the last one carries on, so the others can go
+            for earlier in loads:
+                earlier.pathRequests.close()
+            loads.append(Game(backend.newWindow(Constants.YRES, Constants.XRES),
+                              backend, path))
+            return loads[-1]
+        (loadElapsed, loaded) = bestOf(repeat, load)
+    finally:
+        os.remove(path)
+    identical = True
+    for digest in digests:
+        loaded.logic()
+        if stateDigest(loaded) != digest:
+            identical = False
+            break
+    loaded.pathRequests.close()
+    return {
+        'saveMs': saveElapsed,
+        'loadMs': loadElapsed,
+        'pendingRequests': pending,
+        'turnsChecked': SAVE_CHECK_TURNS,
+        'identical': identical,
+    }
+
+def saving(repeat):
+    """roundTrip with the map stored flat, and then in chunks"""
+    results = {}
+    original = Constants.MAP_CHUNK_SIZE
+    try:
+        for (name, chunkSize) in (('flat', 0), ('chunked', SAVE_CHUNK_SIZE)):
+            Constants.MAP_CHUNK_SIZE = chunkSize
+            results['saving.' + name] = roundTrip(repeat)
+    finally:
+        Constants.MAP_CHUNK_SIZE = original
+    return results
+
+# Name -> benchmark. Benchmarks with several results return a dict of them
+# by name instead.
+BENCHMARKS = [
+    ('generation', generation),
+    ('layout', layout),
+    ('pathfinding', pathfinding),
+    ('fov', fieldOfView),
+    ('draw', draw),
+    ('ticks', ticks),
+    ('saving', saving),
+]
@@ -0,0 +1,152 @@
+# Chunked map storage. A big map's layers are split in to square chunks,
+# which are only allocated once something is written to them, and can be
+# squashed down when they're far from the player and haven't been touched
+# for a while. Layers are still indexed by y * width + x, so nothing using
+# them needs to know.
+
+# Python imports
+import zlib
+from array import array
+
+class ChunkStore(object):
+    """The chunk layout shared by every layer of a map, and which chunks
+    have been used lately"""
+    def __init__(self, height, width, chunkSize):
+        super(ChunkStore, self).__init__()
+        self.height = height
+        self.width = width
+        self.shift = chunkSize.bit_length() - 1
+        if 1 << self.shift != chunkSize:
+            raise ValueError("Chunk size must be a power of two")
+        self.size = chunkSize
+        self.across = (width + chunkSize - 1) >> self.shift
+        self.down = (height + chunkSize - 1) >> self.shift
+        self.layers = []
+        # Set for every chunk read or written since idle chunks were last
+        # packed away
+        self.touched = bytearray(self.across * self.down)
+        self.unpacks = 0
+        self.packs = 0
+
+    def locate(self, index):
+        """(chunk, offset in the chunk) for a flat map index"""
+        (y, x) = divmod(index, self.width)
+        shift = self.shift
+        mask = self.size - 1
+        return ((y >> shift) * self.across + (x >> shift),
+                ((y & mask) << shift) | (x & mask))
+
+    def chunksAround(self, y, x, distance):
+        """Chunks with any cell within distance of (y, x)"""
+        shift = self.shift
+        top = max(0, (y - distance) >> shift)
+        bottom = min(self.down - 1, (y + distance) >> shift)
+        left = max(0, (x - distance) >> shift)
+        right = min(self.across - 1, (x + distance) >> shift)
+        return set(row * self.across + column
+                   for row in range(top, bottom + 1)
+                   for column in range(left, right + 1))
+
+    def packIdle(self, y, x, distance):
+        """Squash down the chunks further than distance from (y, x) that
+        nobody's needed since the last time this was called. Returns how
+        many chunks were packed."""
+        keep = self.chunksAround(y, x, distance)
+        touched = self.touched
+        packed = 0
+        for layer in self.layers:
+            for chunk in range(len(layer.chunks)):
+                if (chunk not in keep and layer.chunks[chunk] is not None and
+                    not touched[chunk]):
+                    layer.pack(chunk)
+                    packed += 1
+        self.touched = bytearray(len(touched))
+        self.packs += packed
+        return packed
+
+    def residentBytes(self):
+        """Memory taken by the chunks that are unpacked, and those that aren't"""
+        unpacked = packed = 0
+        for layer in self.layers:
+            for (chunk, data) in enumerate(layer.chunks):
+                if data is not None:
+                    unpacked += len(data) * layer.itemsize
+                elif layer.packed[chunk] is not None:
+                    packed += len(layer.packed[chunk])
+        return (unpacked, packed)
+
+class ChunkedLayer(object):
+    """One layer of the map, stored a chunk at a time. Behaves enough like
+    the bytearray or array it replaces: indexing by flat index, len,
+    iteration and bytes()."""
+    def __init__(self, store, typecode, fill=0):
+        super(ChunkedLayer, self).__init__()
+        self.store = store
+        self.typecode = typecode
+        self.itemsize = array(typecode).itemsize
+        self.fill = fill
+        count = store.across * store.down
+        self.chunks = [None] * count # Unpacked chunks
+        self.packed = [None] * count # Squashed chunks
+        store.layers.append(self)
+
+    def chunk(self, number):
+        """The unpacked chunk, unpacking or making it if need be"""
+        data = self.chunks[number]
+        if data is None:
+            store = self.store
+            packed = self.packed[number]
+            data = array(self.typecode)
+            if packed is None:
+                data.extend([self.fill] * (store.size * store.size))
+            else:
+                data.frombytes(zlib.decompress(packed))
+                self.packed[number] = None
+                store.unpacks += 1
+            self.chunks[number] = data
+        return data
+
+    def pack(self, number):
+        self.packed[number] = zlib.compress(self.chunks[number].tobytes(), 1)
+        self.chunks[number] = None
+
+    def __len__(self):
+        return self.store.height * self.store.width
+
+    def __getitem__(self, index):
+        store = self.store
+        (number, offset) = store.locate(index)
+        data = self.chunks[number]
+        if data is None:
+            if self.packed[number] is None:
+                return self.fill # Never written, no need to make it
+            data = self.chunk(number)
+        store.touched[number] = 1
+        return data[offset]
+
+    def __setitem__(self, index, value):
+        store = self.store
+        (number, offset) = store.locate(index)
+        store.touched[number] = 1
+        data = self.chunks[number]
+        if data is None:
+            data = self.chunk(number)
+        data[offset] = value
+
+    def __iter__(self):
+        for index in range(len(self)):
+            yield self[index]
+
+    def flat(self):
+        """The whole layer as one flat array"""
+        return array(self.typecode, self)
+
+    def __bytes__(self):
+        return self.flat().tobytes()
+
+    def load(self, values):
+        """Fill an empty layer from a flat sequence, only making the chunks
+        that aren't all fill"""
+        for (index, value) in enumerate(values):
+            if value != self.fill:
+                self[index] = value
@@ -30,16 +30,29 @@ class Constants:
     MAPWIDTH = 180
     MAPHEIGHT = 75
 
-    # Screen width/height: Size of the curses pad. +1 height because
-    # of a crazy off-the-screen cursor bug
-    SCREENWIDTH = MAPWIDTH
-    SCREENHEIGHT = MAPHEIGHT + 1
-
     # Other constants
     DOOR_CLOSE_TIME = 10 # Turns before door closes
     TURNS_BETWEEN_MINUTES = 3 # Turns before minute passes
-    PATHFINDING_HEURISTIC_ADJUSTMENT = 1.001 # Shorter paths in open spaces
+    PATHFINDING_NODE_LIMIT = 100000 # Nodes expanded before A* gives up
+    PATH_CACHE_SIZE = 256 # Routes remembered by the path cache, 0 to turn it off
+    PATH_REPAIR_PATIENCE = 2 # Turns an NPC waits before going round a blockage
+    PATH_REPAIR_REJOIN = 4 # Steps past a blockage a detour rejoins the route
+    PATH_REPAIR_NODE_LIMIT = 200 # Nodes expanded looking for a detour
+    PATHFINDING_WORKERS = 0 # Processes searching for routes, 0 to search in the game loop
+    PATH_REQUESTS_PER_TICK = 4 # Route searches and hand-overs done each tick
+    PATH_WORKER_DELAY = 3 # Ticks before a route from the workers is handed over, whether or not it was ready sooner
+    NPC_DETAIL_MARGIN = 16 # NPCs further than this past the edge of the screen are simulated coarsely, keep it above NPC_COARSE_INTERVAL
+    NPC_COARSE_INTERVAL = 8 # Turns between updates for NPCs simulated coarsely
+    GENERATION_WORKERS = 0 # Processes laying out houses, 0 to do it in-process
+    SAVE_FILE = 'roguedetective.sav' # Where the game gets saved
+    MAP_CHUNK_SIZE = 0 # Store the map in chunks this many cells square (a power of two), 0 for flat layers
+    CHUNK_KEEP_DISTANCE = 96 # Chunks this close to the player are never packed away
+    RENDER_MARGIN = 32 # Map drawn on to the game pad past each edge of the screen
+    TOWN_SPACING = 83 # Between the corners of neighbouring towns
+    WAIT_DOOR_DISTANCE = 10 # Doors opening this close cut a long wait short
     DESC_BOX_WIDTH = 48
+    FOV_CACHE_SIZE = 64 # Viewpoints remembered by the FoV cache
+    FOV_BACKEND = 'python' # 'numpy' to vectorise shadowcasting, if installed
 
     # Debugging constants
     PATHFINDING_DEBUG = False # Turn on random pathfinding
@@ -47,6 +60,8 @@ class Constants:
     FOV_ENABLED = False # Enable shadowcasting
     NPC_ON_NPC_COLLISIONS = False # NPCs collide during pathfinding
     PARTY_AT_MY_PLACE = False # When visiting a neighbour, always go top left
+    PROFILING = False # Time subsystems and show a summary on the bottom line
+    PROFILE_HISTORY = 1000 # Recent timings kept for each profiled span
 
     # Map of keyboard key to action
     KEYMAP = dict()
@@ -70,9 +85,13 @@ class Constants:
     KEYMAP[ord('t')] = InputActions.TALK
 
     KEYMAP[ord('.')] = InputActions.WAIT
+    KEYMAP[ord('w')] = InputActions.WAIT_UNTIL
+
+    KEYMAP[ord('S')] = InputActions.SAVE
 
     COLOUR_WHITE = None
     COLOUR_RED = None
+    COLOUR_YELLOW = None
     COLOUR_GREEN = None
     COLOUR_BLUE = None
 
@@ -1,23 +1,23 @@
 # Our entities, the NPCs and Player.
 
-# Python imports
-import random
-
 # Our imports
 from enums import Direction, Gender
 from plan import Plan
 from constants import Constants
 from behaviours import DefaultBehaviour, Dead
+from fov import FieldOfView
 
-import names, dialogue, screen
+import names, dialogue, screen, rng
 
 class Entity(object):
     """The base entity object, for players and NPCs"""
-    def __init__(self, game):
-        self.x = 0
-        self.y = 15
+    def __init__(self, game, y = 15, x = 0):
+        self.x = x
+        self.y = y
         self.character = '@'
         self.game = game
+        # Stand on the map straight away
+        self.game.grid.occupy(y, x)
 
     def checkObstruction(self, direction = None, steps = 1):
         """Returns true if moving in the given direction isn't allowed"""
@@ -32,24 +32,15 @@ class Entity(object):
         elif direction == Direction.RIGHT:
             candidateX += steps
 
-        key = (candidateY, candidateX)
-        if key in self.game.walls or key in self.game.fences:
+        # Walls, fences and closed doors are all baked in to the grid's
+        # passability layer. Walking off the map is dealt with by the caller.
+        grid = self.game.grid
+        if (grid.inBounds(candidateY, candidateX) and
+            not grid.passable[candidateY * grid.width + candidateX]):
             return True
 
-        if key in self.game.doors:
-            door = self.game.doors[key]
-            if door.closed:
-                return True
-        
-        for npc in self.game.npcs:
-            if (npc.y, npc.x) == key:
-                return True
-
-        for police in self.game.police:
-            if (police.y, police.x) == key:
-                return True
-
-        if (self.game.player.y, self.game.player.x) == key:
+        # Nobody can walk in to anyone else, NPC or player
+        if grid.isOccupied(candidateY, candidateX):
             return True
 
         return False
@@ -75,16 +66,28 @@ class Entity(object):
 
         return False
 
+    def setPosition(self, y, x):
+        """Put the entity at (y, x), keeping the occupancy grid up to date
+        and letting the renderer know both cells need redrawing"""
+        grid = self.game.grid
+        grid.vacate(self.y, self.x)
+        self.game.dirtyCells.mark(self.y, self.x)
+        (self.y, self.x) = (y, x)
+        grid.occupy(y, x)
+        self.game.dirtyCells.mark(y, x)
+
     def move(self, direction, steps=1):
         """Actually move the entity"""
+        (y, x) = (self.y, self.x)
         if direction == Direction.UP:
-            self.y -= steps
+            y -= steps
         elif direction == Direction.DOWN:
-            self.y += steps
+            y += steps
         elif direction == Direction.LEFT:
-            self.x -= steps
+            x -= steps
         elif direction == Direction.RIGHT:
-            self.x += steps
+            x += steps
+        self.setPosition(y, x)
 
     def attemptMove(self, direction):
         """Move the entity one unit in the specified direction, if allowed"""
@@ -114,20 +117,24 @@ class Entity(object):
             self.game.printStatus("")
 
         # Bounce them back if they've walked off the terminal!
-        if (self.x < 0):
-            self.x = 0
+        (y, x) = (self.y, self.x)
+        if (x < 0):
+            x = 0
             moved = False
-        elif (self.x >= Constants.MAPWIDTH):
-            self.x = Constants.MAPWIDTH - 1
+        elif (x >= Constants.MAPWIDTH):
+            x = Constants.MAPWIDTH - 1
             moved = False
 
-        if (self.y < 0):
-            self.y = 0
+        if (y < 0):
+            y = 0
             moved = False
-        elif (self.y >= Constants.MAPHEIGHT):
-            self.y = Constants.MAPHEIGHT - 1
+        elif (y >= Constants.MAPHEIGHT):
+            y = Constants.MAPHEIGHT - 1
             moved = False
 
+        if (y, x) != (self.y, self.x):
+            self.setPosition(y, x)
+
         return moved
 
 #### PLAYER and PLAYER STUFF
@@ -153,128 +160,24 @@ class Player(Entity):
         super(Player, self).__init__(game)
         self.colour = Constants.COLOUR_RED
         self.notebook = Notebook()
+        self.fov = FieldOfView(game)
 
     def generateFov(self):
         """Reveals grid squares if they've never been seen before,
         shows the contents of squares if within FoV"""
-        # Reset the current FoV
-        for tile in self.game.tiles:
-            tile = self.game.tiles[tile]
-            tile.visible = False
-
-        # Start the shadowcast for each octact
-        octants = 8 # This is constant naming gone mad.
-        for octant in range(octants):
-            self.shadowcast(self.y, self.x, 1, Constants.GAMEWIDTH, 1.0, 0.0, octant)
-
-    def shadowcast(self, oY, oX, startRow, rows, startSlope, endSlope, octant):
-        """Calculates the FOV for one octant of the shadowcasting algorithm"""
-        # Set up the transformation values for the octant
-        dX = dY = 0
-        rowY = rowX = offsetY = offsetX = 1
-        xSlope = True
-        if octant == 0 or octant == 5:
-            dY = 1
-            dX = -1
-            rowX = 0
-            offsetY = 0
-        elif octant == 1 or octant == 4:
-            dY = 1
-            dX = 1
-            rowX = 0
-            offsetY = 0
-        elif octant == 2 or octant == 7:
-            dY = 1
-            dX = 1
-            offsetX = 0
-            rowY = 0
-            xSlope = False
-        elif octant == 3 or octant == 6:
-            dY = -1
-            dX = 1
-            offsetX = 0
-            rowY = 0
-            xSlope = False
-
-        if octant == 5 or octant == 4:
-            dY = -dY
-        elif octant == 6 or octant == 7:
-            dX = -dX
-
-        # Iterate across each row and column
-        for row in range(startRow, rows):
-            if startSlope <= endSlope:
-                break
-            blocked = False
-            lastRightSlope = 0
-            for column in range(row+1):
-                # Here, we do the hard bit: Finding the right
-                # tile that we're considering, deciding if it's
-                # in the current scan's FoV, starting child
-                # scans and adjusting the start slope.
-
-                if startSlope <= endSlope:
-                    break
-
-                # Find the target tile.
-                targetY = oY
-                targetX = oX
-                offset = row - column
-                targetY -= dY * rowY * row - dY * offsetY * offset
-                targetX += dX * offsetX * offset - dX * rowX * row
-
-                # Determine if it's inside the cone we're considering.
-                leftSlope  = ((targetX + (0.5 * dX)) - oX) / \
-                             ((targetY + (0.5 * dY)) - oY)
-                rightSlope = ((targetX - (0.5 * dX)) - oX) / \
-                             ((targetY - (0.5 * dY)) - oY)
-                if not xSlope:
-                    leftSlope  = 1 / leftSlope
-                    rightSlope = 1 / rightSlope
-
-                leftSlope = abs(leftSlope)
-                rightSlope = abs(rightSlope)
-
-                if startSlope < rightSlope:
-                    continue
-                if endSlope > leftSlope:
-                    break
-
-                # Light up the tile if we got this far.
-                if (targetY, targetX) in self.game.tiles:
-                    tile = self.game.tiles[(targetY, targetX)]
-                    tile.visible = True
-                    tile.seen = True
-
-                    doorClosed = (targetY, targetX) in self.game.doors and \
-                                 self.game.doors[(targetY, targetX)].closed
-
-                    if (targetY, targetX) in self.game.walls or doorClosed:
-                        # Start child scan if not previously blocked
-                        if not blocked:
-                            self.shadowcast(self.y, self.x, row+1, \
-                                            Constants.GAMEWIDTH - row, \
-                                            startSlope, leftSlope, octant)
-                        lastRightSlope = rightSlope
-                        blocked = True
-                    elif blocked: # If we were blocked, but aren't now..
-                        # We could be clever and work out the slope and stuff.. But
-                        # why bother when we already have it from the last loop?
-                        startSlope = lastRightSlope
-                        blocked = False
-            if blocked: # If the last block in the row scan was a blocker, we stop.
-                break
+        self.fov.update(self.y, self.x)
 
 ##### NPCS
 class NPC(Entity):
     """Super class for all NPCs"""
     def __init__(self, game, y, x):
         """Initialise the player object"""
-        super(NPC, self).__init__(game)
-        self.y = y
-        self.x = x
+        super(NPC, self).__init__(game, y, x)
         self.colour = Constants.COLOUR_WHITE
         self.path = []
+        self.turnsBlocked = 0 # Turns spent waiting for someone to move
+        self.pathRequest = None # The route we're waiting on, if any
+        self.lastUpdateTurn = game.turn - 1 # Turns before this are done
         self.square = None
         self.plan = Plan(self)
         self.currentBehaviour = DefaultBehaviour(self)
@@ -309,7 +212,7 @@ class NPC(Entity):
         self.dialogue.setRootNode(dialogueRoot)
 
         # Fluffy, plot stuff
-        self.gender = random.choice([Gender.MALE, Gender.FEMALE])
+        self.gender = rng.names.choice([Gender.MALE, Gender.FEMALE])
         self.firstName = "Dave"
         if self.gender == Gender.MALE:
             self.firstName = names.getMaleFirstName()
@@ -317,8 +220,8 @@ class NPC(Entity):
             self.firstName = names.getFemaleFirstName()
         self.lastName = names.getLastName()
 
-        self.eyeColour = random.choice(["green", "blue", "brown"])
-        self.hairColour = random.choice(["brown", "red", "blonde"])
+        self.eyeColour = rng.names.choice(["green", "blue", "brown"])
+        self.hairColour = rng.names.choice(["brown", "red", "blonde"])
         self.description = "They have " + self.eyeColour + " eyes and " + self.hairColour + " hair."
 
         # Emotions and states
@@ -348,12 +251,9 @@ class NPC(Entity):
         """If the NPC is alive, carry out their Plan and Behavaiour"""
         if self.alive:
             # Move randomly, or sometimes actually pick a place to go and go there!
-            # If we have a plan and we're not otherwise occupied (to do), execute it
-            self.plan.checkForAndExecutePlanEntry()
-
-            # Once we've decided on a plan (or have no plan), the NPC should first
-            # go to anywhere they're planning on being before performing their 
-            # status action.
+            # The game's scheduler will have already kicked off any plan entry
+            # due this minute, so the NPC should first go to anywhere they're
+            # planning on being before performing their status action.
 
             if self.path and self.alive:
                 (nextY, nextX) = self.path[0]
@@ -364,12 +264,14 @@ class NPC(Entity):
                 # Check for player..
                 if (self.game.player.y, self.game.player.x) == (nextY, nextX):
                     blockedByEntity = True
-                # Check for NPC..
+                # Check for NPC, not counting ourselves..
                 if Constants.NPC_ON_NPC_COLLISIONS:
-                    for npc in self.game.npcs:
-                        if npc is not self:
-                            if (npc.y, npc.x) == (nextY, nextX):
-                                blockedByEntity = True
+                    grid = self.game.grid
+                    occupants = grid.occupancy[nextY * grid.width + nextX]
+                    if (nextY, nextX) == (self.y, self.x):
+                        occupants -= 1
+                    if occupants > 0:
+                        blockedByEntity = True
                 # Check for Door..
                 if (nextY, nextX) in self.game.doors:
                     door = self.game.doors[(nextY, nextX)]
@@ -377,107 +279,57 @@ class NPC(Entity):
                         blockedByDoor = True
                         door.npcOpen()
                 if (not blockedByEntity) and (not blockedByDoor):
-                    (self.y, self.x) = (nextY, nextX)
+                    self.setPosition(nextY, nextX)
                     self.path.pop(0)
+                    self.turnsBlocked = 0
+                elif blockedByEntity:
+                    # Doors open by themselves, but people might not move.
+                    # Give them a moment, then go round.
+                    self.turnsBlocked += 1
+                    if self.turnsBlocked > Constants.PATH_REPAIR_PATIENCE:
+                        self.turnsBlocked = 0
+                        path = self.game.pathFinder.repairPath(
+                            (self.y, self.x), self.path, [(nextY, nextX)])
+                        if path:
+                            self.path = path
             else:
                 if Constants.PATHFINDING_DEBUG:
-                    randnum = random.randint(1, 30)
+                    randnum = rng.ai.randint(1, 30)
                     if randnum == 25:
                         targetX = targetY = 0
                         while True:
-                            targetX = random.randint(1, Constants.MAPWIDTH)
-                            targetY = random.randint(1, Constants.MAPHEIGHT)
+                            targetX = rng.ai.randint(1, Constants.MAPWIDTH)
+                            targetY = rng.ai.randint(1, Constants.MAPHEIGHT)
                             if (targetY, targetX) not in self.game.walls:
                                 break
                         self.path = self.findPath(targetY, targetX)
                 self.currentBehaviour.execute()
 
+    def coarseUpdate(self, turns):
+        """Catch up on a number of turns at once, for when we're far from
+        the player. We walk as far along the path as we would have, straight
+        through doors and anyone in the way, then if there's time left our
+        behaviour gets to act, once."""
+        if not self.alive:
+            return
+        if self.path:
+            steps = min(turns, len(self.path))
+            (y, x) = self.path[steps - 1]
+            del self.path[:steps]
+            self.setPosition(y, x)
+            self.turnsBlocked = 0
+            turns -= steps
+        if turns > 0 and not self.path:
+            self.currentBehaviour.execute()
+
     def findPath(self, targetY, targetX):
-        """A big ol' ripoff of the A* algorithm"""
-        def sld(y1, x1, y2, x2):
-            """Using Euclidean distance as the heuristic"""
-            return ((y1-y2) ** 2) + ((x1-x2) ** 2)
-
-        def manhattan(y1, x1, y2, x2):
-            """Using Manhattan distance as the heuristic"""
-            return (abs(y1 - y2) + abs(x1 - x2))
-
-        def nextCurrent(openSet):
-            bestNode = (1,1)
-            bestScore = None
-            nodeSet = { node: f_score[node] for node in openSet}
-            bestNode = min(nodeSet, key=nodeSet.get)
-            return bestNode
-
-        def spaceObstructed(y, x, game):
-            wallObstruction = (y, x) in game.walls
-
-            # This line WILL cause pathfinding failures if the character is
-            # currently inside a fenced area or is attempting to pathfind into
-            # one.
-            fenceObstruction = (y, x) in game.fences
-            #fenceObstruction = False
-            return wallObstruction or fenceObstruction
-
-        def returnNeighbours(node, game):
-            # Return a list of nodes that aren't walls basically
-            neighbours = []
-            for nX in [-1, 1]:
-                if not spaceObstructed(node[0], node[1] + nX, game):
-                    neighbours.append((node[0], node[1] + nX))
-                if not spaceObstructed(node[0] + nX, node[1], game):
-                    neighbours.append((node[0] + nX, node[1]))
-            return neighbours
-
-        def reconstructPath(current):
-            if current in came_from:
-                rest = reconstructPath(came_from[current])
-                rest.append(current)
-                return rest
-            else:
-                return [current,]
-
-        x = self.x
-        y = self.y
-        goal = (targetY, targetX)
-        closedSet = []
-        openSet = [(y,x)]
-        came_from = {}
-
-        g_score = {}
-        f_score = {}
-        g_score[(y,x)] = 0
-        adjustment = Constants.PATHFINDING_HEURISTIC_ADJUSTMENT
-        heuristicScore = manhattan(y, x, targetY, targetX) * adjustment
-        f_score[(y,x)] = g_score[(y,x)] + heuristicScore
-
-        count = 100000
-
-        while openSet and count > 0:
-            count -= 1
-            current = nextCurrent(openSet)
-            if current == (targetY, targetX):
-                return reconstructPath(current)
-
-            openSet.remove(current)
-            closedSet.append(current)
-            for neighbour in returnNeighbours(current, self.game):
-                if neighbour in closedSet:
-                    continue
-                tentative_g_score = g_score[current] + 1
-                nG_score = -1
-                try:
-                    nG_score = g_score[neighbour]
-                except:
-                    pass
-                if (neighbour not in openSet or 
-                    tentative_g_score < nG_score):
-                    came_from[neighbour] = current
-                    g_score[neighbour] = tentative_g_score
-                    f_score[neighbour] = g_score[neighbour] + sld(neighbour[0], neighbour[1], goal[0], goal[1])
-                    if neighbour not in openSet:
-                        openSet.append(neighbour)
-        return False
+        """Ask the pathfinding engine for a route to the target"""
+        return self.game.pathFinder.findPath((self.y, self.x), (targetY, targetX))
+
+    def requestPath(self, targetY, targetX, behaviour=None):
+        """Queue up a route to the target, which turns up in self.path on a
+        later tick. We'll switch to the behaviour when it does."""
+        self.game.pathRequests.submit(self, (targetY, targetX), behaviour)
 
     def getDescription(self):
         "Returns the description, modifying it for special cases"
@@ -19,6 +19,8 @@ class InputActions:
     LOOK = 8
     TALK = 9
     WAIT = 10
+    SAVE = 11
+    WAIT_UNTIL = 12
 
 class Gender:
     """Enum for genders"""
@@ -0,0 +1,260 @@
+# Field of view. Shadowcasting, plus the bookkeeping that stops us
+# recalculating it when nothing has changed.
+
+# Python imports
+from collections import OrderedDict
+
+# NumPy is optional, it's only needed for the vectorised backend
+try:
+    import numpy
+except ImportError:
+    numpy = None
+
+# Our imports
+from constants import Constants
+from mapgrid import MapGrid
+import profiler
+
+def octantTransform(octant):
+    """The values that map (row, column) in an octant on to the map.
+    Returns (dY, dX, rowY, rowX, offsetY, offsetX, xSlope)"""
+    dX = dY = 0
+    rowY = rowX = offsetY = offsetX = 1
+    xSlope = True
+    if octant == 0 or octant == 5:
+        dY = 1
+        dX = -1
+        rowX = 0
+        offsetY = 0
+    elif octant == 1 or octant == 4:
+        dY = 1
+        dX = 1
+        rowX = 0
+        offsetY = 0
+    elif octant == 2 or octant == 7:
+        dY = 1
+        dX = 1
+        offsetX = 0
+        rowY = 0
+        xSlope = False
+    elif octant == 3 or octant == 6:
+        dY = -1
+        dX = 1
+        offsetX = 0
+        rowY = 0
+        xSlope = False
+
+    if octant == 5 or octant == 4:
+        dY = -dY
+    elif octant == 6 or octant == 7:
+        dX = -dX
+    return (dY, dX, rowY, rowX, offsetY, offsetX, xSlope)
+
+def rowsToEdge(grid, oY, oX, octant):
+    """Rows an octant can scan before it's entirely off the map"""
+    (dY, dX, rowY, rowX, _, _, _) = octantTransform(octant)
+    # Rows step along y for the first four octants and x for the rest
+    if rowY:
+        return (oY if dY > 0 else grid.height - 1 - oY) + 1
+    return (oX if dX > 0 else grid.width - 1 - oX) + 1
+
+def shadowcast(grid, oY, oX, startRow, rows, startSlope, endSlope, octant, lit):
+    """Calculates the FOV for one octant of the shadowcasting algorithm,
+    adding the flat index of every lit tile to lit"""
+    # Set up the transformation values for the octant
+    (dY, dX, rowY, rowX, offsetY, offsetX, xSlope) = octantTransform(octant)
+
+    # Rows past the edge of the map can't light or block anything
+    rows = min(rows, rowsToEdge(grid, oY, oX, octant))
+
+    # Iterate across each row and column
+    opaque = grid.opaque
+    for row in range(startRow, rows):
+        if startSlope <= endSlope:
+            break
+        blocked = False
+        lastRightSlope = 0
+        for column in range(row+1):
+            # Here, we do the hard bit: Finding the right
+            # tile that we're considering, deciding if it's
+            # in the current scan's FoV, starting child
+            # scans and adjusting the start slope.
+
+            if startSlope <= endSlope:
+                break
+
+            # Find the target tile.
+            targetY = oY
+            targetX = oX
+            offset = row - column
+            targetY -= dY * rowY * row - dY * offsetY * offset
+            targetX += dX * offsetX * offset - dX * rowX * row
+
+            # Determine if it's inside the cone we're considering.
+            leftSlope  = ((targetX + (0.5 * dX)) - oX) / \
+                         ((targetY + (0.5 * dY)) - oY)
+            rightSlope = ((targetX - (0.5 * dX)) - oX) / \
+                         ((targetY - (0.5 * dY)) - oY)
+            if not xSlope:
+                leftSlope  = 1 / leftSlope
+                rightSlope = 1 / rightSlope
+
+            leftSlope = abs(leftSlope)
+            rightSlope = abs(rightSlope)
+
+            if startSlope < rightSlope:
+                continue
+            if endSlope > leftSlope:
+                break
+
+            # Light up the tile if we got this far.
+            if grid.inBounds(targetY, targetX):
+                index = targetY * grid.width + targetX
+                lit.add(index)
+
+                # Walls and closed doors block the view
+                if opaque[index]:
+                    # Start child scan if not previously blocked
+                    if not blocked:
+                        shadowcast(grid, oY, oX, row+1, \
+                                   Constants.GAMEWIDTH - row, \
+                                   startSlope, leftSlope, octant, lit)
+                    lastRightSlope = rightSlope
+                    blocked = True
+                elif blocked: # If we were blocked, but aren't now..
+                    # We could be clever and work out the slope and stuff.. But
+                    # why bother when we already have it from the last loop?
+                    startSlope = lastRightSlope
+                    blocked = False
+        if blocked: # If the last block in the row scan was a blocker, we stop.
+            break
+
+class RayTables(object):
+    """Precomputed rays for the NumPy backend. Each octant casts a ray from
+    the origin to every cell on its outermost row, and the tables hold the
+    map offset of each step along every ray."""
+    def __init__(self, radius):
+        super(RayTables, self).__init__()
+        self.radius = radius
+        steps = numpy.arange(1, radius)
+        dy = []
+        dx = []
+        for octant in range(8):
+            (dY, dX, rowY, rowX, offsetY, offsetX, _) = octantTransform(octant)
+            for column in range(radius + 1):
+                # Nearest cell to the ray at each row
+                offsets = numpy.floor(column * steps / float(radius) + 0.5)
+                offsets = offsets.astype(numpy.intp)
+                dy.append(dY * offsetY * offsets - dY * rowY * steps)
+                dx.append(dX * offsetX * offsets - dX * rowX * steps)
+        self.dy = numpy.array(dy)
+        self.dx = numpy.array(dx)
+
+def vectorisedShadowcast(grid, oY, oX, tables):
+    """Casts every ray in the tables at once. A cell is lit if a ray reaches
+    it before hitting a wall or closed door (which are lit themselves).
+    Returns a boolean mask over the flat map."""
+    ys = oY + tables.dy
+    xs = oX + tables.dx
+    inside = (ys >= 0) & (ys < grid.height) & (xs >= 0) & (xs < grid.width)
+    indices = numpy.where(inside, ys * grid.width + xs, 0)
+
+    # Count the blockers strictly before each step of each ray
+    opaque = numpy.frombuffer(grid.opaque, dtype=numpy.uint8)[indices]
+    opaque &= inside
+    blockersBefore = numpy.cumsum(opaque, axis=1) - opaque
+
+    mask = numpy.zeros(grid.height * grid.width, dtype=bool)
+    mask[indices[inside & (blockersBefore == 0)]] = True
+    return mask
+
+class FieldOfView(object):
+    """Keeps the vision layer of the grid in step with what the player can
+    see. Only the tiles lit last time get cleared, and results are cached by
+    viewpoint and the grid's opacity version, so standing still (or coming
+    back to a recent spot) skips the shadowcast altogether. Standing still
+    it's only worked out again when a tile in view changes opacity, since a
+    door opening out of sight can't change what's in sight."""
+    def __init__(self, game):
+        super(FieldOfView, self).__init__()
+        self.game = game
+        self.litCells = frozenset() # Flat indices of the tiles in view
+        self.key = None
+        self.litChanged = False # A tile in view has changed opacity
+        game.grid.opacityWatchers.append(self.cellChanged)
+        self.cache = OrderedDict() # (y, x, opacity version) -> lit cells
+        self.hits = 0
+        self.misses = 0
+        self.rayTables = None # Built on first use by the NumPy backend
+
+    def calculate(self, y, x):
+        """The set of tiles visible from (y, x)"""
+        grid = self.game.grid
+        profiler.count('fov.calculated')
+        # NumPy needs the opacity layer in one piece, so chunked maps
+        # always use the Python version
+        if (Constants.FOV_BACKEND == 'numpy' and numpy is not None and
+            grid.chunks is None):
+            if self.rayTables is None:
+                self.rayTables = RayTables(Constants.GAMEWIDTH)
+            mask = vectorisedShadowcast(grid, y, x, self.rayTables)
+            return frozenset(numpy.flatnonzero(mask).tolist())
+
+        # The pure Python fallback
+        lit = set()
+        octants = 8 # This is constant naming gone mad.
+        for octant in range(octants):
+            shadowcast(grid, y, x, 1, Constants.GAMEWIDTH,
+                       1.0, 0.0, octant, lit)
+        return frozenset(lit)
+
+    def litFrom(self, y, x, version):
+        """Cached version of calculate"""
+        key = (y, x, version)
+        try:
+            lit = self.cache.pop(key)
+            self.hits += 1
+        except KeyError:
+            lit = self.calculate(y, x)
+            self.misses += 1
+            if len(self.cache) >= Constants.FOV_CACHE_SIZE:
+                self.cache.popitem(last=False)
+        # Most recently used entries live at the end
+        self.cache[key] = lit
+        return lit
+
+    def cellChanged(self, index):
+        if index in self.litCells:
+            self.litChanged = True
+
+    def restore(self, y, x, lit):
+        """Take the tiles lit from (y, x) as given, from a saved game,
+        instead of working them out again"""
+        self.key = (y, x, self.game.grid.opacityVersion)
+        self.litChanged = False
+        self.litCells = lit
+
+    def update(self, y, x):
+        """Recalculate the FoV from (y, x), if anything changed"""
+        grid = self.game.grid
+        key = (y, x, grid.opacityVersion)
+        if (self.key is not None and self.key[:2] == (y, x) and
+            not self.litChanged):
+            return
+        self.key = key
+        self.litChanged = False
+        lit = self.litFrom(y, x, grid.opacityVersion)
+        profiler.count('fov.lit', len(lit))
+
+        # Only touch the tiles that came in to or went out of view
+        vision = grid.vision
+        for index in self.litCells - lit:
+            vision[index] &= ~MapGrid.VISIBLE
+        for index in lit - self.litCells:
+            vision[index] |= MapGrid.VISIBLE | MapGrid.SEEN
+
+        # Those same tiles need redrawing
+        if Constants.FOV_ENABLED:
+            for index in self.litCells ^ lit:
+                self.game.dirtyCells.markIndex(index)
+        self.litCells = lit
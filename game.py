@@ -1,43 +1,84 @@
 # The game screen logic, including level creation and whatnot
 
-# External imports
-import curses
-
 # Python imports
-import random, platform, textwrap
+import curses, textwrap
 
 # Our imports
 from constants import Constants
 from enums import Direction, InputActions, Gender
 from entity import Player, Police
-from tiles import Decoration, Tile
-from town import Town
+from tiles import Decoration
+from mapgrid import MapGrid
+from render import MapRenderer, DirtyCells
+from autotile import WallTiler
+from backends import CursesBackend
+from town import Town, generateTowns, townSites
 from plan import Plan
-import screen
+from scheduler import PlanScheduler, TimerWheel, DetailScheduler
+from pathfinding import PathFinder, PathRequests
+from replay import ReplayFinished
+import screen, savegame, rng, profiler
 
 class Game:
     """The game logic itself. The loop and input handling are here."""
-    def __init__(self, screen):
-        """Create the screen, player, assets."""
-        # Some technical items, first
+    def __init__(self, screen, backend = None, savePath = None):
+        """Create the screen, player, assets. The backend makes the pads and
+        blits them, which is curses unless we've been told otherwise. If
+        there's a save file path, the world comes from there instead of
+        being generated."""
+        # Some technical items, first. When profiling, every curses call
+        # gets counted.
+        backend = backend if backend else CursesBackend()
+        if profiler.current.enabled:
+            screen = profiler.CountingWindow(screen, profiler.current)
+            backend = profiler.CountingBackend(backend, profiler.current)
         self.screen = screen
-        self.gameScreen = curses.newpad(Constants.SCREENHEIGHT, Constants.SCREENWIDTH)
+        self.backend = backend
         self.running = True
 
+        # Keys can be written down as they're read, or read from a
+        # recording instead of the screen
+        self.recorder = None
+        self.replayer = None
+
+        # The map itself. The layers are dict-like views on to the grid,
+        # keyed by (y, x). Tiles hold visibility for FoV.
+        self.grid = MapGrid(Constants.MAPHEIGHT, Constants.MAPWIDTH,
+                            Constants.MAP_CHUNK_SIZE)
+        self.walls = self.grid.walls
+        self.doors = self.grid.doors
+        self.decorations = self.grid.decorations
+        self.fences = self.grid.fences
+        self.tiles = self.grid.tiles
+
+        # Cells that changed since the last frame
+        self.dirtyCells = DirtyCells(self.grid)
+
         # Collections of various objects
         self.player = Player(self)
-        self.walls = dict()
-        self.doors = dict()
-        self.decorations = dict()
-        self.fences = dict()
         self.npcs = []
         self.villagers = []
         self.police = []
         self.squares = []
 
-        # Camera
+        # NPCs share a single pathfinding engine, and a scheduler that
+        # runs their plans
+        self.pathFinder = PathFinder(self)
+        self.pathRequests = PathRequests(self.pathFinder,
+                                         Constants.PATHFINDING_WORKERS)
+        self.planScheduler = PlanScheduler()
+
+        # NPCs far from the player are simulated in less detail
+        self.detailScheduler = DetailScheduler(self,
+                                               Constants.NPC_DETAIL_MARGIN,
+                                               Constants.NPC_COARSE_INTERVAL)
+
+        # Camera, and the renderer that draws what's under it
         self.cameraX = 0
         self.cameraY = 0
+        self.mapRenderer = MapRenderer(self)
+        self.gameScreen = self.backend.newPad(*self.mapRenderer.padSize())
+        self.wallTiler = WallTiler(self)
 
         # The current contents of the status line
         # TODO: Maybe rename this
@@ -51,25 +92,34 @@ class Game:
         self.minute = 59
         self.turnsToNextMinute = 0
 
+        # Turns are counted so open doors know when to close. Open doors
+        # wait on a wheel long enough to hold the furthest closing time.
+        self.turn = 0
+        self.doorTimers = TimerWheel(Constants.DOOR_CLOSE_TIME + 1)
+
         ### The actual game creation logic
-        # Random decoration
-        for _ in range(500):
-            (y, x) = (random.randint(1, Constants.MAPHEIGHT - 1), random.randint(1, Constants.MAPWIDTH - 1))
-            self.decorations[(y, x)] = Decoration()
+        self.towns = []
+        self.victim = None
+        self.killer = None
+        if savePath is not None:
+            savegame.loadGame(self, savePath)
+        else:
+            self.generateWorld()
 
-        # Create tiles for visibility and FoV
-        self.tiles = dict()
-        for x in range(Constants.MAPWIDTH):
-            for y in range(Constants.MAPHEIGHT):
-                self.tiles[(y,x)] = Tile()
+    def generateWorld(self):
+        """Make a brand new town, murder and all"""
+        # Random decoration, one for every 27 cells
+        for _ in range(Constants.MAPHEIGHT * Constants.MAPWIDTH // 27):
+            (y, x) = (rng.generation.randint(1, Constants.MAPHEIGHT - 1), rng.generation.randint(1, Constants.MAPWIDTH - 1))
+            self.decorations[(y, x)] = Decoration()
 
         # Town creation
-        self.town = Town(self, 5, 5, 3, 3)
-        self.town2 = Town(self, 5, 88, 3, 3)
+        self.towns = [Town(self, y, x, 3, 3)
+                      for (y, x) in townSites(self.grid.height, self.grid.width, 3, 3)]
+        generateTowns(self, self.towns)
+        self.pathFinder.buildTownGraph(self.towns)
 
         # Setup the murder..
-        self.victim = None
-        self.killer = None
         self.murderSetup()
 
         # Put together the NPC schedules
@@ -77,121 +127,7 @@ class Game:
 
     def initialiseWalls(self):
         """Builds the correct wall graphics"""
-        # This is one of the ugliest things I've ever written.
-        # Don't judge me!
-        for (y, x) in self.walls:
-            wall = self.walls[(y, x)]
-            if wall.character.isdigit():
-                continue
-            wallUp = wallDown = wallLeft = wallRight = False
-            # Check for walls via worst method possible
-            try:
-                self.walls[(y-1, x)]
-                wallUp = True
-            except Exception as e:
-                pass
-            try:
-                self.walls[(y+1, x)]
-                wallDown = True
-            except Exception as e:
-                pass
-            try:
-                self.walls[(y, x-1)]
-                wallLeft = True
-            except Exception as e:
-                pass
-            try:
-                self.walls[(y, x+1)]
-                wallRight = True
-            except Exception as e:
-                pass
-            # Check for doors using the same awful method
-            try:
-                self.doors[(y-1, x)]
-                wallUp = True
-            except Exception as e:
-                pass
-            try:
-                self.doors[(y+1, x)]
-                wallDown = True
-            except Exception as e:
-                pass
-            try:
-                self.doors[(y, x-1)]
-                wallLeft = True
-            except Exception as e:
-                pass
-            try:
-                self.doors[(y, x+1)]
-                wallRight = True
-            except Exception as e:
-                pass
-
-            system = platform.system()
-
-            UpDown = '|'
-            LeftRight = '-'
-            UpLeft = '-'
-            UpRight = '-'
-            DownLeft = '-'
-            DownRight = '-'
-            DownLeftRight = '-'
-            UpLeftRight = '-'
-            LeftUpDown = '|'
-            RightUpDown = '|'
-            UpDownLeftRight = '|'
-
-            # Terrible attempt at getting nice walls in Linux
-            # UpDown = '|'
-            # LeftRight = '-'
-            # UpLeft = chr(0x6a)
-            # UpRight = chr(0x6d)
-            # DownLeft = chr(0x06b)
-            # DownRight = chr(0x6c)
-            # DownLeftRight = chr(0x77)
-            # UpLeftRight = chr(0x76)
-            # LeftUpDown = chr(0x75)
-            # RightUpDown = chr(0x74)
-            # UpDownLeftRight = chr(0x6e)
-            # Smells bad, huh.
-
-            if (system == 'Windows'):
-                LeftRight = chr(0xC4)
-                UpDown = chr(0xB3)
-                UpLeft = chr(0xD9)
-                UpRight = chr(0xC0)
-                DownLeft = chr(0xBF)
-                DownRight = chr(0xDA)
-                DownLeftRight = chr(0xC2)
-                UpLeftRight = chr(0xC1)
-                LeftUpDown = chr(0xB4)
-                RightUpDown = chr(0xC3)
-                UpDownLeftRight = chr(0xC5)
-
-            if (wallLeft or wallRight):
-                wall.character = LeftRight
-            else:
-                wall.character = UpDown
-
-            # Yeah.. This just happened. Next time consider bitstates
-            if (wallUp and wallLeft):
-                wall.character = UpLeft
-            if (wallUp and wallRight):
-                wall.character = UpRight
-            if (wallDown and wallLeft):
-                wall.character = DownLeft
-            if (wallDown and wallRight):
-                wall.character = DownRight
-            if (wallDown and wallLeft and wallRight):
-                wall.character = DownLeftRight
-            if (wallUp and wallLeft and wallRight):
-                wall.character = UpLeftRight
-            if (wallLeft and wallUp and wallDown):
-                wall.character = LeftUpDown
-            if (wallRight and wallUp and wallDown):
-                wall.character = RightUpDown
-            if (wallRight and wallUp and wallDown and wallLeft):
-                wall.character = UpDownLeftRight
+        self.wallTiler.tileAll()
 
     def mainLoop(self):
         """Run the game while a flag is set."""
@@ -199,10 +135,16 @@ class Game:
         self.initialiseWalls()
 
         # Start the main loop
-        while (self.running):
-            self.logic()
-            self.draw()
-            self.handleInput()
+        try:
+            while (self.running):
+                self.logic()
+                self.draw()
+                with profiler.span('input'):
+                    self.handleInput()
+        except ReplayFinished:
+            pass
+        finally:
+            self.pathRequests.close()
 
     def isInCamera(self, entityY, entityX):
         """ Shouldn't be a class method. Determines if we should draw
@@ -212,87 +154,30 @@ class Game:
                 entityX >= self.cameraX and
                 entityX < self.cameraX + Constants.GAMEWIDTH)
 
+    def cameraFor(self, y, x):
+        """Top left of the camera when it's following someone at (y, x),
+        kept from going off the edge of the map"""
+        cameraX = max(0, x - Constants.GAMEWIDTH // 2)
+        cameraX = min(cameraX, Constants.MAPWIDTH - Constants.GAMEWIDTH)
+        cameraY = max(0, y - Constants.GAMEHEIGHT // 2)
+        cameraY = min(cameraY, Constants.MAPHEIGHT - Constants.GAMEHEIGHT)
+        return (cameraY, cameraX)
+
     def draw(self):
         """ Draw it all, but only the stuff that would be on the screen"""
-        # Wipe out the screen.
+        with profiler.span('frame'):
+            self.drawFrame()
+
+    def drawFrame(self):
+        # Wipe out the screen. The game pad keeps the map between frames.
         self.screen.erase()
-        self.gameScreen.erase()
 
         # Sort out the camera
-        self.cameraX = max(0, self.player.x - Constants.GAMEWIDTH // 2)
-        self.cameraX = min(self.cameraX, Constants.MAPWIDTH - Constants.GAMEWIDTH)
-        self.cameraY = max(0, self.player.y - Constants.GAMEHEIGHT // 2)
-        self.cameraY = min(self.cameraY, Constants.MAPHEIGHT - Constants.GAMEHEIGHT)
-        alwaysSeeWalls = False
-
-        # Draw the floors, walls, etc.
-        # Floors first, then we'll override them
-        for x in range(0, Constants.MAPWIDTH):
-            for y in range(0, Constants.MAPHEIGHT):
-                if not self.isInCamera(y, x):
-                    continue
-
-                if self.tiles[(y, x)].visible or not Constants.FOV_ENABLED:
-                    self.gameScreen.addstr(
-                        y,
-                        x,
-                        '.',
-                        Constants.COLOUR_GREEN)
-
-                    if (y, x) in self.decorations:
-                        decoration = self.decorations[(y, x)]
-                        self.gameScreen.addstr(y,
-                                               x,
-                                               decoration.character,
-                                               decoration.colour)
-
-                    # Fences
-                    if (y, x) in self.fences:
-                        fence = self.fences[(y, x)]
-                        self.gameScreen.addstr(y,
-                                               x,
-                                               fence.character,
-                                               fence.colour)
-
-                    # Doors
-                    if (y, x) in self.doors:
-                        door = self.doors[(y, x)]
-                        self.gameScreen.addstr(y,
-                                               x,
-                                               door.character,
-                                               door.colour)
-
-                if (self.tiles[(y,x)].seen
-                    and (alwaysSeeWalls or self.tiles[(y,x)].visible)
-                    or not Constants.FOV_ENABLED):
-                    if (y, x) in self.walls:
-                        wall = self.walls[(y,x)]
-                        self.gameScreen.addstr(y,
-                                               x,
-                                               wall.character,
-                                               wall.colour)
-
-        # Draw the entities like players, NPCs
-        for npc in self.npcs:
-            npcPos = (npc.y, npc.x)
-            if npcPos in self.tiles:
-                tile = self.tiles[npcPos]
-                if (self.isInCamera(npc.y, npc.x) and
-                    tile.visible or not Constants.FOV_ENABLED):
-                    if (npc in self.villagers and
-                        self.player.notebook.isNpcKnown(npc) and
-                        npc.alive):
-                        character = str(npc.square.house.number)
-                    else:
-                        character = npc.character
-                    self.gameScreen.addstr(npc.y,
-                                           npc.x,
-                                           character,
-                                           npc.colour)
+        (self.cameraY, self.cameraX) = self.cameraFor(self.player.y, self.player.x)
 
-        player = self.player
-        self.gameScreen.addstr(player.y, player.x,
-                               player.character, player.colour)
+        # Repaint whatever changed on the map, and the entities on top
+        self.mapRenderer.draw(self.gameScreen, self.cameraY, self.cameraX,
+                              Constants.GAMEHEIGHT, Constants.GAMEWIDTH)
 
         # Status line printing
         self.screen.addstr(0, 0, self.statusLine)
@@ -309,23 +194,36 @@ class Game:
 
         self.screen.noutrefresh()
 
-        self.gameScreen.noutrefresh(self.cameraY, self.cameraX, 1, 1, Constants.GAMEHEIGHT, Constants.GAMEWIDTH)
+        self.gameScreen.noutrefresh(self.cameraY - self.mapRenderer.top,
+                                    self.cameraX - self.mapRenderer.left,
+                                    1, 1, Constants.GAMEHEIGHT, Constants.GAMEWIDTH)
 
         screen.moveCursorToPlayer(self.screen, self.player)
 
         # Blit the screen
-        curses.doupdate()
+        self.backend.doupdate()
+
+    def readKey(self):
+        """Every key the game reads comes through here, so it can be
+        recorded or replayed"""
+        if self.replayer is not None:
+            key = self.replayer.nextKey()
+        else:
+            key = self.screen.getch()
+        if self.recorder is not None:
+            self.recorder.record(key)
+        return key
 
     def getAnyKey(self):
         """Utility funciton that waits until a ANY input has been entered,
         does not return anything."""
-        self.screen.getch()
+        self.readKey()
 
     def getKey(self, acceptedInputs = Constants.KEYMAP.values()):
         """Utility funciton that waits until a valid input has been entered."""
         gotKey = False
         while not gotKey:
-            got = self.screen.getch()
+            got = self.readKey()
             if (got in Constants.KEYMAP and
                 Constants.KEYMAP[got] in acceptedInputs):
                 key = Constants.KEYMAP[got]
@@ -336,7 +234,7 @@ class Game:
         been entered."""
         gotKey = False
         while not gotKey:
-            got = self.screen.getch()
+            got = self.readKey()
             if (got >= ord('1') and got <= ord(str(numberOfChoices))):
                 return int(chr(got))
 
@@ -371,7 +269,7 @@ class Game:
         if message:
             self.printStatus(message)
         while not gotYesNo:
-            key = self.screen.getch()
+            key = self.readKey()
             if key is ord('y') or key is ord('n'):
                 gotYesNo = True
         self.printStatus("")
@@ -382,8 +280,8 @@ class Game:
         present."""
         actionTaken = True
         self.printStatus("Which direction?")
-        direction = self.screen.getch()
-        success = random.randrange(100) > 80
+        direction = self.readKey()
+        success = rng.combat.randrange(100) > 80
         playerPos = [self.player.y, self.player.x]
         try:
             direction = Constants.KEYMAP[direction]
@@ -435,7 +333,7 @@ class Game:
 
     def openDoor(self):
         self.printStatus("Which direction?")
-        direction = self.screen.getch()
+        direction = self.readKey()
         playerPos = [self.player.y, self.player.x]
         actionTaken = True
         try:
@@ -464,10 +362,14 @@ class Game:
             actionTaken = False
         return actionTaken
 
+    def visibleNpcs(self):
+        """The NPCs the player can see on screen"""
+        return [npc for npc in self.npcs
+                if self.grid.isVisible(npc.y, npc.x) and
+                self.isInCamera(npc.y, npc.x)]
+
     def selectVisibleNPC(self, promptText, selectionAction):
-        visibleNpcs = [npc for npc in self.npcs
-                       if self.tiles[npc.y, npc.x].visible and
-                       self.isInCamera(npc.y, npc.x)]
+        visibleNpcs = self.visibleNpcs()
         error = "No-one in sight!"
         npcSelected = None
         if visibleNpcs:
@@ -548,14 +450,131 @@ class Game:
                 actionTaken = self.talk()
             elif key == InputActions.WAIT:
                 actionTaken = True # Do nothing.
+            elif key == InputActions.WAIT_UNTIL:
+                self.waitUntil()
+                actionTaken = False # The turns have already gone by
+            elif key == InputActions.SAVE:
+                self.saveGame()
+                actionTaken = False # Saving doesn't take a turn
+
+    def getText(self, prompt, allowed, maxLength):
+        """Utility function for typing a short answer on the status line.
+        Only the allowed characters are taken. Returns the text, or None if
+        escape was pressed."""
+        text = ""
+        while True:
+            self.printStatus(prompt + " " + text)
+            key = self.readKey()
+            if key in (10, 13, curses.KEY_ENTER):
+                self.printStatus("")
+                return text
+            elif key == 27: # Escape
+                self.printStatus("")
+                return None
+            elif key in (8, 127, curses.KEY_BACKSPACE):
+                text = text[:-1]
+            elif (0 <= key < 256 and chr(key) in allowed and
+                  len(text) < maxLength):
+                text += chr(key)
+
+    def waitUntil(self):
+        """Asks how long to wait, either a number of minutes or a time of
+        day, and waits"""
+        text = self.getText("Wait how many minutes, or until when (HH:MM)?",
+                            "0123456789:", 5)
+        if not text:
+            return
+        try:
+            if ':' in text:
+                (hour, minute) = [int(part) for part in text.split(':')]
+                if not (0 <= hour < 24 and 0 <= minute < 60):
+                    raise ValueError(text)
+                # The time it is now means this time tomorrow
+                minutes = ((hour * 60 + minute) -
+                           (self.hour * 60 + self.minute)) % (24 * 60)
+                minutes = minutes or 24 * 60
+            else:
+                minutes = int(text)
+        except ValueError:
+            self.printStatus("That's not a time.")
+            return
+        if minutes <= 0:
+            self.printStatus("You don't wait at all.")
+            return
+        if minutes > 24 * 60:
+            self.printStatus("You can wait up to a day.")
+            return
+        reason = self.fastForward(minutes)
+        self.draw()
+        time = str(self.hour).zfill(2) + ":" + str(self.minute).zfill(2)
+        if reason:
+            self.printStatus(reason + " It's " + time + ".")
+        else:
+            self.printStatus("You wait until " + time + ".")
+
+    def fastForward(self, minutes):
+        """Runs the game for a number of minutes without drawing or asking
+        for input. Stops early if someone comes in to view or a door opens
+        nearby, returning why, or None if the wait ran its course. Anyone
+        who leaves the view and comes back stops it too. The player's FoV
+        is only worked out while there's someone on screen who might be in
+        it."""
+        grid = self.grid
+        doorsOpened = []
+        def cellChanged(index):
+            (y, x) = divmod(index, grid.width)
+            if (grid.passable[index] and grid.doorAt(index) is not None and
+                max(abs(y - self.player.y), abs(x - self.player.x)) <=
+                Constants.WAIT_DOOR_DISTANCE):
+                doorsOpened.append(index)
+        grid.passabilityWatchers.append(cellChanged)
+
+        seen = set(self.visibleNpcs())
+        reason = None
+        try:
+            while minutes > 0 and self.running:
+                clock = (self.hour, self.minute)
+                with profiler.span('tick'):
+                    self.tick()
+                profiler.current.endTick()
+                if (self.hour, self.minute) != clock:
+                    minutes -= 1
+                if doorsOpened:
+                    reason = "A door opens nearby."
+                    break
+                onScreen = [npc for npc in self.npcs
+                            if self.isInCamera(npc.y, npc.x)]
+                if not onScreen:
+                    seen.clear()
+                    continue
+                self.player.generateFov()
+                visible = set(npc for npc in onScreen
+                              if grid.isVisible(npc.y, npc.x))
+                if visible - seen:
+                    reason = "Someone comes in to view."
+                    break
+                seen = visible
+        finally:
+            grid.passabilityWatchers.remove(cellChanged)
+        self.player.generateFov()
+        self.updateBottomLine()
+        return reason
+
+    def saveGame(self):
+        """Save the game to the save file"""
+        try:
+            savegame.saveGame(self, Constants.SAVE_FILE)
+            self.printStatus("Saved to " + Constants.SAVE_FILE + ".")
+        except (IOError, OSError) as e:
+            self.printStatus("Couldn't save: " + str(e))
 
     def murderSetup(self):
         """Picks the victim and murderer, and kills the victim"""
-        victim = random.choice(self.villagers)
+        victim = rng.generation.choice(self.villagers)
         self.victim = victim
         killer = None
         while True:
-            killer = random.choice(self.villagers)
+            killer = rng.generation.choice(self.villagers)
             if killer is not victim:
                 self.killer = killer
                 killer.killer = True
@@ -569,15 +588,15 @@ class Game:
         self.doors[doorY, doorX].locked = False
 
         # Put the player outside the dead guy's house
-        self.player.y = house.absoluteY + house.frontDoorPos[0] + 1
-        self.player.x = house.absoluteX + house.frontDoorPos[1]
+        self.player.setPosition(house.absoluteY + house.frontDoorPos[0] + 1,
+                                house.absoluteX + house.frontDoorPos[1])
 
         # Spawn some cops around the dead guy and next to our character
         copSpawnLocations = [(self.player.y, self.player.x + 1)]
-        for _ in range(0, random.randint(4, 5)):
-            y = random.randint(house.absoluteY + 1,
+        for _ in range(0, rng.generation.randint(4, 5)):
+            y = rng.generation.randint(house.absoluteY + 1,
                                house.absoluteY + house.height - 1)
-            x = random.randint(house.absoluteX + 1,
+            x = rng.generation.randint(house.absoluteX + 1,
                                house.absoluteX + house.width - 1)
             copSpawnLocations.append((y,x))
 
@@ -600,15 +619,34 @@ class Game:
                     randomSquareIndex = None
                     while True:
                         # Don't visit the dead guy, that's morbid
-                        randomSquare = random.choice(self.squares)
+                        randomSquare = rng.generation.choice(self.squares)
                         if randomSquare.npc.alive:
                             break
                     visitNeighbour = Plan.VisitNeighbour(npc, randomSquare)
-                    randomHour = random.randint(0, 8) + 8
+                    randomHour = rng.generation.randint(0, 8) + 8
                     npc.plan.addPlanEntry(randomHour, 0, visitNeighbour)
 
     def logic(self):
         """Run all the assorted logic for all entities and advance the clock"""
+        with profiler.span('tick'):
+            self.tick()
+            with profiler.span('tick.fov'):
+                self.player.generateFov()
+        profiler.current.endTick()
+        self.updateBottomLine()
+
+    def updateBottomLine(self):
+        """Player position and the clock, plus the profiler's summary if
+        it's on"""
+        self.bottomLine = "(" + str(self.player.x) + ", " + str(self.player.y) + ")"
+        time = str(self.hour).zfill(2) + ":" + str(self.minute).zfill(2)
+        self.bottomLine += " " + time
+        if profiler.current.enabled:
+            self.bottomLine += " " + profiler.current.overlay()
+            self.bottomLine = self.bottomLine[:Constants.XRES - 1]
+
+    def tick(self):
+        """Advance the clock and everyone but the player by a turn"""
         if self.turnsToNextMinute <= 0:
             self.minute += 1
             if self.minute == 60:
@@ -617,16 +655,24 @@ class Game:
                 if self.hour == 24:
                     self.hour = 0
             self.turnsToNextMinute = Constants.TURNS_BETWEEN_MINUTES
+            # Kick off any plans due at the new time
+            self.planScheduler.dispatch(self.hour, self.minute)
+            # Every so often, pack away map chunks nobody's been near
+            if self.minute % 10 == 0:
+                self.grid.packIdleChunks(self.player.y, self.player.x)
         else:
             self.turnsToNextMinute -= 1
 
-        for npc in self.npcs:
-            npc.update()
-        for door in self.doors:
-            self.doors[door].update()
-        self.player.generateFov()
-
-        # Update the bottom line
-        self.bottomLine = "(" + str(self.player.x) + ", " + str(self.player.y) + ")"
-        time = str(self.hour).zfill(2) + ":" + str(self.minute).zfill(2)
-        self.bottomLine += " " + time
+        # Hand out any routes NPCs have been waiting on
+        with profiler.span('tick.paths'):
+            self.pathRequests.update()
+
+        with profiler.span('tick.npcs'):
+            self.detailScheduler.update(self.turn)
+        # Only the doors due to close this turn need looking at
+        with profiler.span('tick.doors'):
+            doors = self.doorTimers.take(self.turn)
+            for door in doors:
+                door.update(self.turn)
+            profiler.count('doors.updated', len(doors))
+        self.turn += 1
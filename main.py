@@ -3,13 +3,20 @@
 # External imports
 import curses
 
+# Python imports
+import argparse, time
+
 # Our imports
 from game import Game
 from constants import Constants
 from title import TitleScreen
+from backends import CursesBackend, HeadlessBackend
+from replay import Recording, InputRecorder, InputReplayer, stateDigest
+import savegame, rng, profiler
 
-def main(stdscr):
-    """Initialises the Game object and basically gets out of the way"""
+def main(stdscr, savePath=None, recordPath=None):
+    """Initialises the Game object and basically gets out of the way. If
+    there's a record path, the keys pressed are written there at the end."""
     # Make sure the screen is big enough for our amazing game
     (ywidth, xwidth) = stdscr.getmaxyx()
     if (ywidth < Constants.YRES or xwidth < Constants.XRES):
@@ -18,21 +25,103 @@ def main(stdscr):
         return -1
 
     # Set-up the colours we'll be using'
-    curses.start_color()
-    curses.init_pair(1, curses.COLOR_RED, curses.COLOR_BLACK)
-    curses.init_pair(2, curses.COLOR_YELLOW, curses.COLOR_BLACK)
-    curses.init_pair(3, curses.COLOR_GREEN, curses.COLOR_BLACK)
-    curses.init_pair(5, curses.COLOR_BLUE, curses.COLOR_BLACK)
-    Constants.initColours()
+    backend = CursesBackend()
+    backend.initColours()
 
     # Make the window..
-    win = curses.newwin(Constants.YRES, Constants.XRES)
+    win = backend.newWindow(Constants.YRES, Constants.XRES)
     win.bkgd(' ', curses.color_pair(0))
 
     # Start the game, with the title screen.
-    title = TitleScreen(win)
+    recorder = InputRecorder() if recordPath is not None else None
+    title = TitleScreen(win, backend, savePath, recorder)
     title.execute()
+    if recorder is not None:
+        recorder.recording.save(recordPath)
+
+def headless(turns, loadPath=None, savePath=None):
+    """Runs the simulation for a number of turns without a terminal, and
+    reports how quickly it went. The world can come from a save file, and
+    be saved again at the end."""
+    backend = HeadlessBackend()
+    backend.initColours()
+    win = backend.newWindow(Constants.YRES, Constants.XRES)
+
+    start = time.time()
+    game = Game(win, backend, loadPath)
+    game.initialiseWalls()
+    generated = time.time()
+
+    for _ in range(turns):
+        game.logic()
+        game.draw()
+    finished = time.time()
+    game.pathRequests.close()
+
+    if savePath is not None:
+        savegame.saveGame(game, savePath)
+
+    elapsed = finished - generated
+    if loadPath is not None:
+        print("Loaded the world in {:.3f}s".format(generated - start))
+    else:
+        print("Generated the world from seed {} in {:.3f}s".format(
+            rng.masterSeed, generated - start))
+    print("Ran {} turns in {:.3f}s ({:.1f} turns/s), clock reads {:02d}:{:02d}".format(
+        turns, elapsed, turns / elapsed if elapsed else float('inf'),
+        game.hour, game.minute))
+
+def replayGame(path):
+    """Plays a recorded game again without a terminal, from the same seed
+    and with the same keys, and reports where it ended up"""
+    recording = Recording.load(path)
+    rng.seed(recording.seed)
+    Constants.PATHFINDING_WORKERS = recording.workers
+    backend = HeadlessBackend()
+    backend.initColours()
+    win = backend.newWindow(Constants.YRES, Constants.XRES)
+
+    start = time.time()
+    game = Game(win, backend)
+    game.replayer = InputReplayer(recording)
+    game.mainLoop()
+    elapsed = time.time() - start
+
+    print("Replayed {} keys from seed {} in {:.3f}s, {} turns, clock reads {:02d}:{:02d}".format(
+        len(recording.keys), recording.seed, elapsed, game.turn,
+        game.hour, game.minute))
+    print("State digest {}".format(stateDigest(game)))
 
 if __name__ == '__main__':
     """Handles all the nasty stuff to do with curses set-up + tear-down"""
-    curses.wrapper(main)
+    parser = argparse.ArgumentParser(description="Rogue Detective")
+    parser.add_argument('--headless', type=int, metavar='TURNS',
+                        help="simulate TURNS turns without a terminal")
+    parser.add_argument('--load', metavar='FILE',
+                        help="carry on from a saved game instead of making a new one")
+    parser.add_argument('--save', metavar='FILE',
+                        help="save the game at the end of a --headless run")
+    parser.add_argument('--seed', type=int,
+                        help="start a new game from this seed")
+    parser.add_argument('--record', metavar='FILE',
+                        help="write the seed and every key pressed to FILE")
+    parser.add_argument('--replay', metavar='FILE',
+                        help="play a recorded game again without a terminal")
+    parser.add_argument('--profile', metavar='FILE',
+                        help="time the game's subsystems, showing a summary on the bottom line, "
+                             "and write the results to FILE (CSV if it ends in .csv, JSON otherwise)")
+    args = parser.parse_args()
+    if args.load is not None and (args.record or args.replay):
+        parser.error("recordings start from a new game, so can't be used with --load")
+    if args.seed is not None:
+        rng.seed(args.seed)
+    if args.profile is not None:
+        profiler.enable()
+    if args.replay is not None:
+        replayGame(args.replay)
+    elif args.headless is not None:
+        headless(args.headless, args.load, args.save)
+    else:
+        curses.wrapper(main, args.load, args.record)
+    if args.profile is not None:
+        profiler.current.dump(args.profile)
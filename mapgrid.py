@@ -0,0 +1,338 @@
+# The map grid. Every static layer of the map lives here in a flat array,
+# indexed by y * width + x, so looking up a cell never allocates. Big maps
+# can keep their layers in chunks instead, indexed just the same.
+
+# Python imports
+from array import array
+
+# Our imports
+from constants import Constants
+from tiles import Tile
+from chunks import ChunkStore, ChunkedLayer
+
+class GlyphView(object):
+    """A wall, fence or decoration as seen through a MapGrid glyph layer.
+    Changing the character or colour writes straight back to the grid."""
+    def __init__(self, grid, layer, index):
+        self.grid = grid
+        self.layer = layer
+        self.index = index
+
+    def getCharacter(self):
+        return self.grid.glyphs[self.layer[self.index]][0]
+
+    def setCharacter(self, character):
+        self.layer[self.index] = self.grid.glyphFor(character, self.colour)
+
+    def getColour(self):
+        return self.grid.glyphs[self.layer[self.index]][1]
+
+    def setColour(self, colour):
+        self.layer[self.index] = self.grid.glyphFor(self.character, colour)
+
+    character = property(getCharacter, setCharacter)
+    colour = property(getColour, setColour)
+
+class Layer(object):
+    """Dictionary-style access to one layer of the grid, keyed by (y, x).
+    Lets the town generation code carry on treating the map as dicts."""
+    def __init__(self, grid, flag):
+        self.grid = grid
+        self.flag = flag
+
+    def indexOf(self, key):
+        """Flat index for the key, or None if it's off the map"""
+        (y, x) = key
+        grid = self.grid
+        if 0 <= y < grid.height and 0 <= x < grid.width:
+            return y * grid.width + x
+        return None
+
+    def __contains__(self, key):
+        index = self.indexOf(key)
+        return index is not None and bool(self.grid.terrain[index] & self.flag)
+
+    def __getitem__(self, key):
+        index = self.indexOf(key)
+        if index is None or not self.grid.terrain[index] & self.flag:
+            raise KeyError(key)
+        return self.view(index)
+
+    def __setitem__(self, key, value):
+        index = self.indexOf(key)
+        if index is None:
+            raise KeyError(key)
+        self.store(index, value)
+        self.grid.terrain[index] |= self.flag
+        self.grid.refreshCell(index)
+        self.grid.terrainChanged(index)
+
+    def __delitem__(self, key):
+        index = self.indexOf(key)
+        if index is None or not self.grid.terrain[index] & self.flag:
+            raise KeyError(key)
+        self.grid.terrain[index] &= ~self.flag
+        self.grid.refreshCell(index)
+        self.grid.terrainChanged(index)
+
+    def __iter__(self):
+        width = self.grid.width
+        flag = self.flag
+        for (index, terrain) in enumerate(self.grid.terrain):
+            if terrain & flag:
+                yield divmod(index, width)
+
+    def __len__(self):
+        flag = self.flag
+        return sum(1 for terrain in self.grid.terrain if terrain & flag)
+
+    def get(self, key, default=None):
+        try:
+            return self[key]
+        except KeyError:
+            return default
+
+    def keys(self):
+        return list(self)
+
+    def values(self):
+        return [self[key] for key in self]
+
+    def items(self):
+        return [(key, self[key]) for key in self]
+
+    def view(self, index):
+        """Override me: returns the object stored at index"""
+        return None
+
+    def store(self, index, value):
+        """Override me: stores the object at index"""
+        pass
+
+class GlyphLayer(Layer):
+    """Layer whose cells are just a character and a colour"""
+    def __init__(self, grid, flag, glyphs):
+        super(GlyphLayer, self).__init__(grid, flag)
+        self.glyphs = glyphs
+
+    def view(self, index):
+        return GlyphView(self.grid, self.glyphs, index)
+
+    def store(self, index, value):
+        self.glyphs[index] = self.grid.glyphFor(value.character, value.colour)
+
+class DoorLayer(Layer):
+    """Doors keep their state, so the grid stores an index into a door table"""
+    def view(self, index):
+        return self.grid.doorTable[self.grid.doorIndex[index]]
+
+    def store(self, index, door):
+        grid = self.grid
+        if grid.doorIndex[index]:
+            grid.doorTable[grid.doorIndex[index]] = door
+        else:
+            grid.doorIndex[index] = len(grid.doorTable)
+            grid.doorTable.append(door)
+
+    def __delitem__(self, key):
+        # The door has to be gone before the cell's refreshed, or it'd
+        # still count as closed
+        index = self.indexOf(key)
+        grid = self.grid
+        if index is None or not grid.terrain[index] & self.flag:
+            raise KeyError(key)
+        grid.doorTable[grid.doorIndex[index]] = None
+        grid.doorIndex[index] = 0
+        super(DoorLayer, self).__delitem__(key)
+
+    def __iter__(self):
+        # Much quicker than scanning the terrain
+        for door in self.grid.doorTable:
+            if door is not None:
+                yield (door.y, door.x)
+
+    def __len__(self):
+        return len(self.grid.doorTable) - self.grid.doorTable.count(None)
+
+class TileLayer(Layer):
+    """Every cell on the map has a tile, which is a view of the vision layer"""
+    def __contains__(self, key):
+        return self.indexOf(key) is not None
+
+    def __getitem__(self, key):
+        index = self.indexOf(key)
+        if index is None:
+            raise KeyError(key)
+        return Tile(self.grid, index)
+
+    def __setitem__(self, key, value):
+        raise TypeError("Tiles are fixed to the grid")
+
+    def __delitem__(self, key):
+        raise TypeError("Tiles are fixed to the grid")
+
+    def __iter__(self):
+        width = self.grid.width
+        for index in range(len(self.grid.vision)):
+            yield divmod(index, width)
+
+    def __len__(self):
+        return len(self.grid.vision)
+
+class MapGrid(object):
+    """Fixed-size flat layers holding the map. The terrain layer holds
+    flags for what's in each cell, passability and opacity are derived from
+    it whenever it changes, and doors are indexed into a door table."""
+
+    # Terrain flags
+    WALL = 1
+    FENCE = 2
+    DOOR = 4
+    DECORATION = 8
+
+    # Vision flags
+    VISIBLE = Tile.VISIBLE
+    SEEN = Tile.SEEN
+
+    def __init__(self, height = Constants.MAPHEIGHT, width = Constants.MAPWIDTH,
+                 chunkSize = Constants.MAP_CHUNK_SIZE):
+        """Layers are flat arrays, unless there's a chunk size, in which
+        case they're stored a chunk at a time"""
+        super(MapGrid, self).__init__()
+        self.height = height
+        self.width = width
+        self.chunks = ChunkStore(height, width, chunkSize) if chunkSize else None
+
+        # The layers themselves
+        self.terrain = self.newLayer('B')
+        self.passable = self.newLayer('B', 1)
+        self.opaque = self.newLayer('B')
+        self.opacityVersion = 0 # Bumped whenever a cell's opacity changes
+        self.opacityWatchers = [] # Called with the index when it changes
+        self.passabilityWatchers = [] # Called with the index when it changes
+        self.terrainWatchers = [] # Called with the index when a layer changes
+        self.doorIndex = self.newLayer('H')
+        self.doorTable = [None] # Index 0 means 'no door'
+
+        # Characters and colours are interned in a shared glyph table
+        self.glyphs = [(' ', None)]
+        self.glyphIndices = {}
+        # Every house number is a glyph of its own, so a big map has a
+        # lot of them
+        self.wallGlyphs = self.newLayer('H')
+        self.fenceGlyphs = self.newLayer('H')
+        self.decorationGlyphs = self.newLayer('H')
+
+        # How many entities are standing in each cell
+        self.occupancy = self.newLayer('H')
+
+        # Tiles only need to know if they're visible or have been seen
+        seen = 0 if Constants.FOV_ENABLED else MapGrid.SEEN
+        self.vision = self.newLayer('B', seen)
+
+        # The dict-style facades
+        self.walls = GlyphLayer(self, MapGrid.WALL, self.wallGlyphs)
+        self.fences = GlyphLayer(self, MapGrid.FENCE, self.fenceGlyphs)
+        self.decorations = GlyphLayer(self, MapGrid.DECORATION,
+                                      self.decorationGlyphs)
+        self.doors = DoorLayer(self, MapGrid.DOOR)
+        self.tiles = TileLayer(self, 0)
+
+    def newLayer(self, typecode, fill = 0):
+        """A layer covering the map with every cell set to fill"""
+        if self.chunks is not None:
+            return ChunkedLayer(self.chunks, typecode, fill)
+        if typecode == 'B':
+            return bytearray([fill]) * (self.height * self.width)
+        return array(typecode, [fill]) * (self.height * self.width)
+
+    def loadLayer(self, name, values):
+        """Replace the named layer with the flat values given"""
+        if self.chunks is not None:
+            old = getattr(self, name)
+            self.chunks.layers.remove(old)
+            layer = ChunkedLayer(self.chunks, old.typecode, old.fill)
+            layer.load(values)
+            values = layer
+        setattr(self, name, values)
+        if name in ('wallGlyphs', 'fenceGlyphs', 'decorationGlyphs'):
+            # The glyph layer facades hold on to their arrays
+            self.walls.glyphs = self.wallGlyphs
+            self.fences.glyphs = self.fenceGlyphs
+            self.decorations.glyphs = self.decorationGlyphs
+
+    def packIdleChunks(self, y, x):
+        """Squash down chunks far from (y, x) that haven't been needed
+        lately, if the map's chunked"""
+        if self.chunks is not None:
+            self.chunks.packIdle(y, x, Constants.CHUNK_KEEP_DISTANCE)
+
+    def index(self, y, x):
+        return y * self.width + x
+
+    def inBounds(self, y, x):
+        return 0 <= y < self.height and 0 <= x < self.width
+
+    def glyphFor(self, character, colour):
+        """Index of the (character, colour) pair in the glyph table"""
+        glyph = (character, colour)
+        try:
+            return self.glyphIndices[glyph]
+        except KeyError:
+            if len(self.glyphs) > 65535:
+                raise ValueError("Too many distinct glyphs on the map")
+            self.glyphIndices[glyph] = len(self.glyphs)
+            self.glyphs.append(glyph)
+            return self.glyphIndices[glyph]
+
+    def doorAt(self, index):
+        """The door at the index, or None"""
+        return self.doorTable[self.doorIndex[index]]
+
+    def refreshCell(self, index):
+        """Recalculate passability and opacity after the cell changed"""
+        terrain = self.terrain[index]
+        door = self.doorTable[self.doorIndex[index]]
+        doorClosed = door is not None and door.closed
+        passable = not (terrain & (MapGrid.WALL | MapGrid.FENCE) or doorClosed)
+        if passable != self.passable[index]:
+            self.passable[index] = passable
+            for watcher in self.passabilityWatchers:
+                watcher(index)
+        opaque = bool(terrain & MapGrid.WALL) or doorClosed
+        if opaque != self.opaque[index]:
+            self.opaque[index] = opaque
+            self.opacityVersion += 1
+            for watcher in self.opacityWatchers:
+                watcher(index)
+
+    def terrainChanged(self, index):
+        """Something was added to or removed from a layer at index"""
+        for watcher in self.terrainWatchers:
+            watcher(index)
+
+    def doorChanged(self, door):
+        """Doors call this when they open or close"""
+        if self.inBounds(door.y, door.x):
+            index = self.index(door.y, door.x)
+            if self.doorTable[self.doorIndex[index]] is door:
+                self.refreshCell(index)
+
+    def occupy(self, y, x):
+        """An entity has arrived at (y, x)"""
+        if self.inBounds(y, x):
+            self.occupancy[y * self.width + x] += 1
+
+    def vacate(self, y, x):
+        """An entity has left (y, x)"""
+        if self.inBounds(y, x):
+            self.occupancy[y * self.width + x] -= 1
+
+    def isOccupied(self, y, x):
+        """True if anyone is standing at (y, x)"""
+        return (self.inBounds(y, x) and
+                self.occupancy[y * self.width + x] > 0)
+
+    def isVisible(self, y, x):
+        return (self.inBounds(y, x) and
+                bool(self.vision[y * self.width + x] & MapGrid.VISIBLE))
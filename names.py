@@ -1,7 +1,7 @@
 # The name generator class returns names! And if it can't, it returns Dave or Davina.
 
-# Python imports
-import random
+# Our imports
+import rng
 
 maleFirstNames = [
 "James",
@@ -311,7 +311,7 @@ lastNames = [
 
 def getAndRemoveName(names, default):
     try:
-        name = random.choice(names)
+        name = rng.names.choice(names)
         names.remove(name)
         return name
     except:
@@ -0,0 +1,613 @@
+# The pathfinding engine. NPCs ask it for routes around the map.
+
+# Python imports
+import heapq
+from concurrent.futures import ProcessPoolExecutor
+from array import array
+from collections import OrderedDict, deque
+
+# Our imports
+from constants import Constants
+from mapgrid import MapGrid
+import profiler
+
+def manhattan(y1, x1, y2, x2):
+    """Manhattan distance, which is consistent for four-way movement"""
+    return abs(y1 - y2) + abs(x1 - x2)
+
+def aStar(terrain, width, height, start, goal, limit, avoid=()):
+    """A* over a four-connected grid, where walls and fences in the terrain
+    layer are impassable, as are any flat indices in avoid. Nodes are flat
+    indices in to the layer.
+    Returns the list of (y, x) steps from start to goal inclusive, or False
+    if there's no route or we gave up after expanding limit nodes."""
+    (goalY, goalX) = goal
+    if start == goal:
+        return [start]
+    blocking = MapGrid.WALL | MapGrid.FENCE
+    startNode = start[0] * width + start[1]
+    goalNode = goalY * width + goalX
+
+    # Open set entries are (f, h, node). Ties on f are broken towards the
+    # goal, which keeps paths short in open spaces.
+    h = manhattan(start[0], start[1], goalY, goalX)
+    openSet = [(h, h, startNode)]
+    budget = limit
+    g_score = {startNode: 0}
+    came_from = {}
+    closedSet = set()
+
+    while openSet and limit > 0:
+        (_, _, current) = heapq.heappop(openSet)
+        if current == goalNode:
+            # Walk the chain back iteratively
+            path = [divmod(current, width)]
+            while current in came_from:
+                current = came_from[current]
+                path.append(divmod(current, width))
+            path.reverse()
+            profiler.count('astar.nodes', budget - limit)
+            return path
+        if current in closedSet:
+            # Stale entry, we already found a better route here
+            continue
+        closedSet.add(current)
+        limit -= 1
+
+        (y, x) = divmod(current, width)
+        tentative_g_score = g_score[current] + 1
+        for (neighbour, nY, nX) in ((current - 1, y, x - 1),
+                                    (current - width, y - 1, x),
+                                    (current + 1, y, x + 1),
+                                    (current + width, y + 1, x)):
+            if nY < 0 or nY >= height or nX < 0 or nX >= width:
+                continue
+            if neighbour in closedSet or terrain[neighbour] & blocking:
+                continue
+            if neighbour in avoid:
+                continue
+            if tentative_g_score < g_score.get(neighbour, tentative_g_score + 1):
+                came_from[neighbour] = current
+                g_score[neighbour] = tentative_g_score
+                h = manhattan(nY, nX, goalY, goalX)
+                heapq.heappush(openSet,
+                               (tentative_g_score + h, h, neighbour))
+    profiler.count('astar.nodes', budget - limit)
+    return False
+
+# Worker processes search their own copy of the terrain, taken once the
+# map's been generated. Walls and fences don't move after that.
+workerTerrain = None
+
+def initWorker(terrain, width, height):
+    """Process pool initialiser, stores the terrain snapshot"""
+    global workerTerrain
+    workerTerrain = (terrain, width, height)
+
+def searchSnapshot(start, goal):
+    """Runs in a worker, A* over the terrain snapshot"""
+    (terrain, width, height) = workerTerrain
+    return aStar(terrain, width, height, start, goal,
+                 Constants.PATHFINDING_NODE_LIMIT)
+
+class PathRequest(object):
+    """A route an NPC has asked for and is waiting on. The behaviour, if
+    any, is what the NPC switches to when the route arrives."""
+    def __init__(self, npc, start, goal, behaviour):
+        super(PathRequest, self).__init__()
+        self.npc = npc
+        self.start = start
+        self.goal = goal
+        self.behaviour = behaviour
+
+class PathRequests(object):
+    """Queue of routes NPCs are waiting on, so a lot of them asking at once
+    (say, at the top of the hour) doesn't stall a frame. With workers the
+    searches run on a process pool, otherwise in the game loop. Either way
+    the main thread only does so much of it each tick, and the NPCs carry
+    on with whatever they were doing until their route turns up. Routes
+    from the pool are handed over a fixed number of ticks after they were
+    asked for, however quickly the workers got to them, so the game plays
+    out the same every time."""
+    def __init__(self, pathFinder, workers):
+        super(PathRequests, self).__init__()
+        self.pathFinder = pathFinder
+        self.workers = workers
+        self.pool = None # Started on first use, once the map's finished
+        self.waiting = deque() # Requests that haven't been searched yet
+        self.running = deque() # (tick due, request, future) out on the pool
+        self.ready = deque() # (request, path) waiting to be handed over
+        self.ticks = 0 # Times update has been called
+
+    def submit(self, npc, goal, behaviour=None):
+        """Ask for a route from where the NPC is to the goal. Any request
+        the NPC already had waiting is superseded."""
+        request = PathRequest(npc, (npc.y, npc.x), goal, behaviour)
+        npc.pathRequest = request
+        path = self.pathFinder.cache.get(request.start, goal)
+        if path is not None:
+            self.ready.append((request, path))
+        else:
+            self.waiting.append(request)
+
+    def resubmit(self, request, due):
+        """Send a request from a saved game back out to the pool, to be
+        handed over at the tick it was due. Without workers it just waits
+        its turn instead."""
+        request.npc.pathRequest = request
+        if self.workers <= 0:
+            self.waiting.append(request)
+            return
+        if self.pool is None:
+            self.startPool()
+        future = self.pool.submit(searchSnapshot, request.start, request.goal)
+        self.running.append((due, request, future))
+
+    def startPool(self):
+        grid = self.pathFinder.game.grid
+        self.pool = ProcessPoolExecutor(
+            max_workers=self.workers, initializer=initWorker,
+            initargs=(bytes(grid.terrain), grid.width, grid.height))
+
+    def update(self):
+        """Called every tick to move the requests along"""
+        budget = Constants.PATH_REQUESTS_PER_TICK
+        if self.workers > 0:
+            # Hand everything to the pool, and pick up what's due
+            if self.waiting and self.pool is None:
+                self.startPool()
+            due = self.ticks + Constants.PATH_WORKER_DELAY
+            while self.waiting:
+                request = self.waiting.popleft()
+                try:
+                    future = self.pool.submit(searchSnapshot, request.start,
+                                              request.goal)
+                except Exception:
+                    # The pool's broken, so search in the game loop from
+                    # now on
+                    self.waiting.appendleft(request)
+                    self.close()
+                    self.workers = 0
+                    break
+                self.running.append((due, request, future))
+        while self.running and self.running[0][0] <= self.ticks:
+            (_, request, future) = self.running.popleft()
+            if request.npc.pathRequest is request:
+                self.ready.append((request, self.result(request, future)))
+        self.ticks += 1
+        if self.workers == 0:
+            while self.waiting and budget > 0:
+                request = self.waiting.popleft()
+                if request.npc.pathRequest is not request:
+                    continue # Superseded, don't waste a search on it
+                path = self.pathFinder.findUncached(request.start,
+                                                    request.goal)
+                self.ready.append((request, path))
+                budget -= 1
+
+        while self.ready and budget > 0:
+            (request, path) = self.ready.popleft()
+            budget -= self.deliver(request, path)
+
+    def result(self, request, future):
+        """The route a worker found, waiting for it if need be. If the
+        worker fell over, the route's found here instead."""
+        try:
+            path = future.result()
+        except Exception:
+            return self.pathFinder.findUncached(request.start, request.goal)
+        if path:
+            self.pathFinder.cache.store(request.start, request.goal, path)
+        return path
+
+    def deliver(self, request, path):
+        """Give the NPC its route. If it's wandered off since asking, join
+        it back up to the start of the route first. Returns how many
+        searches that took."""
+        npc = request.npc
+        if npc.pathRequest is not request:
+            return 0
+        npc.pathRequest = None
+        if not npc.alive:
+            return 0
+        searches = 0
+        position = (npc.y, npc.x)
+        if path and position != request.start:
+            grid = self.pathFinder.game.grid
+            searches += 1
+            link = aStar(grid.terrain, grid.width, grid.height, position,
+                         request.start, Constants.PATH_REPAIR_NODE_LIMIT)
+            if link:
+                path = link + path[1:]
+            else:
+                searches += 1
+                path = self.pathFinder.findPath(position, request.goal)
+        npc.path = path
+        if request.behaviour is not None:
+            npc.currentBehaviour = request.behaviour
+        return searches
+
+    def close(self):
+        """Shut the pool down, if there is one"""
+        if self.pool is not None:
+            self.pool.shutdown(cancel_futures=True)
+            self.pool = None
+
+class PathCache(object):
+    """Routes we've already found, keyed by (start, goal) and evicting the
+    least recently used. Walls and fences don't move after generation, so a
+    route only goes stale when a cell on it changes passability: a door
+    along it opening or closing, or something being built in the way."""
+    def __init__(self, grid, size):
+        super(PathCache, self).__init__()
+        self.grid = grid
+        self.size = size
+        self.paths = OrderedDict() # (start, goal) -> steps
+        self.routesThrough = dict() # Flat index -> keys of routes using it
+        self.hits = 0
+        self.misses = 0
+        self.invalidations = 0
+        grid.passabilityWatchers.append(self.cellChanged)
+
+    def get(self, start, goal):
+        """A copy of the cached route from start to goal, or None"""
+        key = (start, goal)
+        if key not in self.paths:
+            self.misses += 1
+            return None
+        self.hits += 1
+        self.paths.move_to_end(key)
+        return list(self.paths[key])
+
+    def store(self, start, goal, path):
+        """Remember a route, and which cells it goes through"""
+        if self.size <= 0:
+            return # A size of 0 turns the cache off
+        key = (start, goal)
+        self.discard(key)
+        if len(self.paths) >= self.size:
+            self.discard(next(iter(self.paths)))
+        self.paths[key] = list(path)
+        for (y, x) in path:
+            self.routesThrough.setdefault(self.grid.index(y, x), set()).add(key)
+
+    def discard(self, key):
+        """Forget a route, if we have it"""
+        path = self.paths.pop(key, None)
+        if path is None:
+            return
+        for (y, x) in path:
+            index = self.grid.index(y, x)
+            keys = self.routesThrough.get(index)
+            if keys is not None:
+                keys.discard(key)
+                if not keys:
+                    del self.routesThrough[index]
+
+    def cellChanged(self, index):
+        """The grid tells us whenever a cell's passability changes"""
+        for key in list(self.routesThrough.get(index, ())):
+            self.discard(key)
+            self.invalidations += 1
+
+class PathFinder(object):
+    """Finds routes across the game map. Walls and fences are impassable,
+    doors are not (NPCs open them as they go).
+    Long routes go over the town graph once it's built, with everything
+    else (and anything the graph can't manage) left to A*. Routes are
+    cached, so NPCs get a copy of one we've found before.
+    This WILL cause pathfinding failures if the character is currently
+    inside a fenced area or is attempting to pathfind into one."""
+    # Routes shorter than this aren't worth taking to the roads for
+    LOCAL_DISTANCE = 20
+
+    def __init__(self, game):
+        super(PathFinder, self).__init__()
+        self.game = game
+        self.townGraph = None
+        self.cache = PathCache(game.grid, Constants.PATH_CACHE_SIZE)
+
+    def buildTownGraph(self, towns):
+        """Build the abstract graph over the towns, once they're on the map"""
+        self.townGraph = TownGraph(self.game.grid)
+        self.townGraph.build(towns)
+
+    def findPath(self, start, goal):
+        """Returns a list of (y, x) steps from start to goal, starting with
+        the start position itself, or False if there's no route"""
+        path = self.cache.get(start, goal)
+        if path is not None:
+            return path
+        return self.findUncached(start, goal)
+
+    def findUncached(self, start, goal):
+        """findPath, for when we already know the cache doesn't have it"""
+        grid = self.game.grid
+        if not (grid.inBounds(start[0], start[1]) and
+                grid.inBounds(goal[0], goal[1])):
+            return False
+        path = self.search(start, goal)
+        if path:
+            self.cache.store(start, goal, path)
+        return path
+
+    def repairPath(self, position, path, blocked):
+        """Detour round the blocked cell at the head of path, which is the
+        rest of a route being walked from position. Only the stretch up to
+        a few steps past the blockage is searched again, and the detour is
+        spliced on to the rest of the route. Returns the new path, or False
+        if there's no way round close by."""
+        grid = self.game.grid
+        avoid = set(grid.index(y, x) for (y, x) in blocked)
+        # Rejoin the route at the first free step far enough past it
+        for rejoin in range(min(Constants.PATH_REPAIR_REJOIN, len(path) - 1),
+                            len(path)):
+            if grid.index(path[rejoin][0], path[rejoin][1]) not in avoid:
+                break
+        else:
+            return False
+        detour = aStar(grid.terrain, grid.width, grid.height, position,
+                       path[rejoin], Constants.PATH_REPAIR_NODE_LIMIT, avoid)
+        if not detour:
+            return False
+        return detour[1:] + path[rejoin + 1:]
+
+    def search(self, start, goal):
+        """Find a new route, over the town graph if it's a long one"""
+        grid = self.game.grid
+        if (self.townGraph is not None and
+            manhattan(start[0], start[1], goal[0], goal[1]) >= PathFinder.LOCAL_DISTANCE):
+            path = self.townGraph.findPath(start, goal)
+            if path:
+                return path
+        return aStar(grid.terrain, grid.width, grid.height, start, goal,
+                     Constants.PATHFINDING_NODE_LIMIT)
+
+class DistanceField(object):
+    """Steps to the nearest goal cell from every cell in a rectangle of the
+    map, found with a breadth first search out from the goals. Walls and
+    fences block it, same as A*. Anything following the field downhill is
+    on a shortest route to the goals, as long as the walls don't move."""
+    UNREACHED = -1
+
+    def __init__(self, terrain, mapWidth, top, left, height, width, goals):
+        super(DistanceField, self).__init__()
+        self.top = top
+        self.left = left
+        self.height = height
+        self.width = width
+        self.distances = array('i', [DistanceField.UNREACHED]) * (height * width)
+
+        blocking = MapGrid.WALL | MapGrid.FENCE
+        frontier = deque()
+        for (y, x) in goals:
+            node = self.node(y, x)
+            if node is not None and self.distances[node] == DistanceField.UNREACHED:
+                self.distances[node] = 0
+                frontier.append(node)
+        while frontier:
+            current = frontier.popleft()
+            distance = self.distances[current] + 1
+            (y, x) = divmod(current, width)
+            for (neighbour, nY, nX) in ((current - 1, y, x - 1),
+                                        (current - width, y - 1, x),
+                                        (current + 1, y, x + 1),
+                                        (current + width, y + 1, x)):
+                if nY < 0 or nY >= height or nX < 0 or nX >= width:
+                    continue
+                if self.distances[neighbour] != DistanceField.UNREACHED:
+                    continue
+                if terrain[(top + nY) * mapWidth + left + nX] & blocking:
+                    continue
+                self.distances[neighbour] = distance
+                frontier.append(neighbour)
+
+    def node(self, y, x):
+        """Index of the map cell (y, x) in the field, or None if it's
+        outside the rectangle"""
+        (y, x) = (y - self.top, x - self.left)
+        if 0 <= y < self.height and 0 <= x < self.width:
+            return y * self.width + x
+        return None
+
+    def distance(self, y, x):
+        """Steps from (y, x) to the nearest goal, or None if there's no
+        route within the rectangle"""
+        node = self.node(y, x)
+        if node is None or self.distances[node] == DistanceField.UNREACHED:
+            return None
+        return self.distances[node]
+
+    def pathFrom(self, y, x):
+        """Follows the field downhill from (y, x). Returns the list of (y, x)
+        steps to the nearest goal, starting with (y, x), or False if the
+        field doesn't reach there"""
+        distance = self.distance(y, x)
+        if distance is None:
+            return False
+        path = [(y, x)]
+        while distance > 0:
+            for (nY, nX) in ((y, x - 1), (y - 1, x), (y, x + 1), (y + 1, x)):
+                if self.distance(nY, nX) == distance - 1:
+                    (y, x) = (nY, nX)
+                    break
+            distance -= 1
+            path.append((y, x))
+        return path
+
+class TownGraph(object):
+    """The abstract graph for long routes. Nodes are the doorstep outside
+    every front door and the road junction at the corner of every square,
+    and edges follow the roads between them (plus a link between the
+    nearest junctions of each pair of towns). The route along each edge is
+    found once, with A*, when the graph's built, and saved along with the
+    game so loading doesn't have to find them again."""
+    # How many nearby nodes a start or goal out in the open connects to
+    LOCAL_LINKS = 4
+    # How much further than the closest pair of junctions two towns can be
+    # and still get a link
+    TOWN_LINK_SLACK = 10
+
+    def __init__(self, grid):
+        super(TownGraph, self).__init__()
+        self.grid = grid
+        self.nodes = [] # Node number -> (y, x)
+        self.numbers = dict() # (y, x) -> node number
+        self.edges = dict() # Node number -> list of (neighbour, cost)
+        self.segments = dict() # (node, neighbour) -> steps between them
+        self.links = [] # (node, neighbour) for every edge, in the order added
+        self.houses = [] # (house, doorstep node number)
+
+    def build(self, towns):
+        """Lay the graph over the towns, once they're on the map"""
+        junctions = []
+        for town in towns:
+            size = town.GRID_SIZE
+            # The junction below and to the right of each square, plus one
+            # down the left edge of the town for the first column
+            corners = dict()
+            for ((row, column), square) in town.squares.items():
+                corners[(row, column)] = (square.y + size, square.x + size)
+                if column == 0:
+                    corners[(row, -1)] = (square.y + size, square.x - 1)
+            for ((row, column), corner) in corners.items():
+                for neighbour in ((row, column + 1), (row + 1, column)):
+                    if neighbour in corners:
+                        self.link(corner, corners[neighbour])
+
+            # Doorsteps join the road junctions either side of them
+            for ((row, column), square) in town.squares.items():
+                house = square.house
+                (doorY, doorX) = house.frontDoor()
+                doorstep = (doorY + 1, doorX)
+                self.link(doorstep, corners[(row, column)])
+                self.link(doorstep, corners[(row, column - 1)])
+                if doorstep in self.numbers:
+                    self.houses.append((house, self.numbers[doorstep]))
+            junctions.append(list(corners.values()))
+
+        # Join each pair of towns along the edges that face each other,
+        # wherever their junctions are about as close as they get
+        for (index, town) in enumerate(junctions):
+            for other in junctions[index + 1:]:
+                pairs = [(manhattan(a[0], a[1], b[0], b[1]), a, b)
+                         for a in town for b in other]
+                if not pairs:
+                    continue
+                closest = min(pairs)[0]
+                for (distance, a, b) in pairs:
+                    if distance <= closest + TownGraph.TOWN_LINK_SLACK:
+                        self.link(a, b)
+
+    def node(self, position):
+        """The number of the node at position, adding it if it's new"""
+        if position not in self.numbers:
+            self.numbers[position] = len(self.nodes)
+            self.nodes.append(position)
+            self.edges[self.numbers[position]] = []
+        return self.numbers[position]
+
+    def link(self, a, b):
+        """Find the route between a and b, and add an edge for it"""
+        grid = self.grid
+        if not (grid.inBounds(a[0], a[1]) and grid.inBounds(b[0], b[1])):
+            return
+        path = aStar(grid.terrain, grid.width, grid.height, a, b,
+                     Constants.PATHFINDING_NODE_LIMIT)
+        if path:
+            self.addEdge(self.node(a), self.node(b), path)
+
+    def addEdge(self, first, second, path):
+        """Join two nodes with the steps between them"""
+        cost = len(path) - 1
+        self.edges[first].append((second, cost))
+        self.edges[second].append((first, cost))
+        self.segments[(first, second)] = path
+        self.segments[(second, first)] = path[::-1]
+        self.links.append((first, second))
+
+    def houseAt(self, y, x):
+        """The (house, doorstep node) for the house at (y, x), or None"""
+        for (house, doorstep) in self.houses:
+            if house.contains(y, x):
+                return (house, doorstep)
+        return None
+
+    def localLegs(self, position):
+        """Routes from position on to the graph, as a dict of node number
+        -> list of steps from position to the node. Inside a house that's
+        out of the front door, otherwise it's to the nearest few nodes."""
+        inside = self.houseAt(position[0], position[1])
+        if inside is not None:
+            (house, doorstep) = inside
+            path = house.frontDoorField().pathFrom(position[0], position[1])
+            if not path:
+                return dict()
+            return {doorstep: path + [self.nodes[doorstep]]}
+
+        grid = self.grid
+        nearest = sorted(range(len(self.nodes)),
+                         key=lambda node: manhattan(position[0], position[1],
+                                                    self.nodes[node][0],
+                                                    self.nodes[node][1]))
+        legs = dict()
+        for node in nearest[:TownGraph.LOCAL_LINKS]:
+            path = aStar(grid.terrain, grid.width, grid.height, position,
+                         self.nodes[node], Constants.PATHFINDING_NODE_LIMIT)
+            if path:
+                legs[node] = path
+        return legs
+
+    def findPath(self, start, goal):
+        """Plans a route over the graph and stitches the segments together.
+        Returns the list of (y, x) steps from start to goal inclusive, or
+        False if the graph can't connect them."""
+        # Within a house the fields do better than the roads ever could
+        inside = self.houseAt(start[0], start[1])
+        if inside is not None and inside == self.houseAt(goal[0], goal[1]):
+            return False
+
+        startLegs = self.localLegs(start)
+        goalLegs = self.localLegs(goal)
+        if not startLegs or not goalLegs:
+            return False
+
+        # Dijkstra, starting from every node the start can reach. The goal
+        # legs are walked backwards, so their cost counts on the way out.
+        distances = dict()
+        cameFrom = dict()
+        openSet = []
+        for (node, leg) in startLegs.items():
+            distances[node] = len(leg) - 1
+            heapq.heappush(openSet, (len(leg) - 1, node))
+        best = None
+        while openSet:
+            (distance, current) = heapq.heappop(openSet)
+            if distance > distances[current]:
+                continue
+            if best is not None and distance >= best[0]:
+                break
+            if current in goalLegs:
+                total = distance + len(goalLegs[current]) - 1
+                if best is None or total < best[0]:
+                    best = (total, current)
+            for (neighbour, cost) in self.edges[current]:
+                if distance + cost < distances.get(neighbour, distance + cost + 1):
+                    distances[neighbour] = distance + cost
+                    cameFrom[neighbour] = current
+                    heapq.heappush(openSet, (distance + cost, neighbour))
+        if best is None:
+            return False
+
+        # Walk back through the nodes, then refine them in to steps
+        current = best[1]
+        route = [current]
+        while current in cameFrom:
+            current = cameFrom[current]
+            route.append(current)
+        route.reverse()
+        path = list(startLegs[route[0]])
+        for (a, b) in zip(route, route[1:]):
+            path.extend(self.segments[(a, b)][1:])
+        path.extend(goalLegs[route[-1]][-2::-1])
+        return path
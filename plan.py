@@ -35,9 +35,9 @@ class Plan(object):
             # This takes them to just inside the door.
             targetY = self.square.y + self.square.houseYOffset + house.frontDoorPos[0] - 1
             targetX = self.square.x + self.square.houseXOffset + house.frontDoorPos[1]
-            self.npc.path = self.npc.findPath(targetY, targetX)
-            self.npc.currentBehaviour = behaviours.VisitingHouse(self.npc,
-                                                                 self.square.house)
+            self.npc.requestPath(targetY, targetX,
+                                 behaviours.VisitingHouse(self.npc,
+                                                          self.square.house))
             return True
 
     def __init__(self, npc):
@@ -46,28 +46,32 @@ class Plan(object):
         self.planEntries = dict() # (hour, minute) -> PlanEntry
 
     def addPlanEntry(self, hour, minute, plan):
-        """Abstraction for adding PlanEntries to the plan"""
+        """Abstraction for adding PlanEntries to the plan. The game's
+        scheduler calls us back when it's time."""
         self.planEntries[(hour, minute)] = plan
+        self.npc.game.planScheduler.schedule(self, hour, minute)
 
-    def checkForAndExecutePlanEntry(self):
-        """Also removes the PlanEntry from the dict to avoid repeating it"""
-        hour = self.npc.game.hour
-        minute = self.npc.game.minute
-        if (hour, minute) in self.planEntries:
-            planEntry = self.planEntries[(hour, minute)]
-            actionSuccessful = planEntry.action()
-            if (not actionSuccessful) and planEntry.shouldReschedule:
-                # Should write helper functions for adding times,
-                # but for now..
-                (newHour, newMinute) = (hour + planEntry.rescheduleTime[0],
-                                        minute + planEntry.rescheduleTime[1])
-                while newMinute >= 60:
-                    newHour += 1
-                    newMinute -= 60
-                while newHour >= 24:
-                    newHour -= 24
-                self.planEntries[(newHour, newMinute)] = planEntry
-            elif actionSuccessful:
-                del self.planEntries[(hour, minute)]
-
-
+    def executePlanEntry(self, hour, minute):
+        """Run the PlanEntry due at hour:minute. Successful entries are
+        removed to avoid repeating them, failures are either rescheduled or
+        left to try again same time tomorrow."""
+        if (hour, minute) not in self.planEntries:
+            return
+        planEntry = self.planEntries[(hour, minute)]
+        actionSuccessful = planEntry.action()
+        if actionSuccessful:
+            del self.planEntries[(hour, minute)]
+        elif planEntry.shouldReschedule:
+            # Should write helper functions for adding times,
+            # but for now..
+            (newHour, newMinute) = (hour + planEntry.rescheduleTime[0],
+                                    minute + planEntry.rescheduleTime[1])
+            while newMinute >= 60:
+                newHour += 1
+                newMinute -= 60
+            while newHour >= 24:
+                newHour -= 24
+            del self.planEntries[(hour, minute)]
+            self.addPlanEntry(newHour, newMinute, planEntry)
+        else:
+            self.npc.game.planScheduler.schedule(self, hour, minute)
@@ -0,0 +1,212 @@
+# Built-in profiling. Subsystems are timed with named spans and count what
+# they do with counters, and the profiler keeps a rolling history of each
+# span's timings. It's off unless it's been enabled, in which case it can
+# show a summary on the bottom line and dump everything when the game ends.
+
+# Python imports
+import csv, json, time
+from collections import deque
+
+# Our imports
+from constants import Constants
+
+# Upper edges of the histogram buckets, in milliseconds. Anything slower
+# goes in a last, open-ended bucket.
+BUCKETS = (0.25, 0.5, 1, 2, 4, 8, 16, 32, 64)
+
+class Span(object):
+    """Times the block it's used around, for the named span"""
+    def __init__(self, profiler, name):
+        super(Span, self).__init__()
+        self.profiler = profiler
+        self.name = name
+        self.start = 0.0
+
+    def __enter__(self):
+        self.start = time.perf_counter()
+        return self
+
+    def __exit__(self, *exception):
+        self.profiler.record(self.name, time.perf_counter() - self.start)
+        return False
+
+class NullSpan(object):
+    """Stands in for a span when the profiler's off"""
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exception):
+        return False
+
+NULL_SPAN = NullSpan()
+
+class Timings(object):
+    """Everything recorded for one span. Totals cover the whole run, the
+    history just the most recent samples."""
+    def __init__(self, historySize):
+        super(Timings, self).__init__()
+        self.calls = 0
+        self.total = 0.0
+        self.longest = 0.0
+        self.history = deque(maxlen=historySize)
+
+    def add(self, seconds):
+        self.calls += 1
+        self.total += seconds
+        self.longest = max(self.longest, seconds)
+        self.history.append(seconds)
+
+    def percentile(self, fraction):
+        """The given percentile of the recent samples, in seconds"""
+        if not self.history:
+            return 0.0
+        ordered = sorted(self.history)
+        return ordered[min(len(ordered) - 1, int(fraction * len(ordered)))]
+
+    def histogram(self):
+        """Counts of the recent samples in each bucket"""
+        counts = [0] * (len(BUCKETS) + 1)
+        for seconds in self.history:
+            milliseconds = seconds * 1000
+            bucket = 0
+            while bucket < len(BUCKETS) and milliseconds > BUCKETS[bucket]:
+                bucket += 1
+            counts[bucket] += 1
+        return counts
+
+    def summary(self):
+        return {
+            'calls': self.calls,
+            'totalMs': self.total * 1000,
+            'meanMs': self.total * 1000 / self.calls if self.calls else 0.0,
+            'p50Ms': self.percentile(0.5) * 1000,
+            'p95Ms': self.percentile(0.95) * 1000,
+            'maxMs': self.longest * 1000,
+            'histogram': self.histogram(),
+        }
+
+class Profiler(object):
+    """Spans, counters and their histories"""
+    def __init__(self, historySize):
+        super(Profiler, self).__init__()
+        self.enabled = False
+        self.historySize = historySize
+        self.timings = dict()
+        self.counters = dict()
+        self.tickStart = dict() # Counter values when the current tick began
+        self.lastTick = dict()  # What each counter did over the last tick
+
+    def span(self, name):
+        if not self.enabled:
+            return NULL_SPAN
+        return Span(self, name)
+
+    def record(self, name, seconds):
+        if name not in self.timings:
+            self.timings[name] = Timings(self.historySize)
+        self.timings[name].add(seconds)
+
+    def count(self, name, amount=1):
+        if self.enabled:
+            self.counters[name] = self.counters.get(name, 0) + amount
+
+    def endTick(self):
+        """Note how much each counter went up by since the last tick"""
+        if not self.enabled:
+            return
+        self.lastTick = dict((name, value - self.tickStart.get(name, 0))
+                             for (name, value) in self.counters.items())
+        self.tickStart = dict(self.counters)
+
+    def overlay(self):
+        """A one line summary: recent tick and frame times, and what the
+        counters did last tick"""
+        parts = []
+        for name in ('tick', 'frame'):
+            timings = self.timings.get(name)
+            if timings is not None:
+                parts.append("{} {:.1f}/{:.1f}ms".format(
+                    name, timings.percentile(0.5) * 1000,
+                    timings.percentile(0.95) * 1000))
+        for (name, label) in (('astar.nodes', 'A*'), ('fov.lit', 'fov'),
+                              ('curses.calls', 'curses'),
+                              ('doors.updated', 'doors')):
+            parts.append("{} {}".format(label, self.lastTick.get(name, 0)))
+        return ' '.join(parts)
+
+    def report(self):
+        return {
+            'spans': dict((name, timings.summary())
+                          for (name, timings) in sorted(self.timings.items())),
+            'counters': dict(sorted(self.counters.items())),
+            'bucketsMs': list(BUCKETS),
+        }
+
+    def dump(self, path):
+        """Write the report to path, as CSV if it ends in .csv and JSON
+        otherwise"""
+        report = self.report()
+        with open(path, 'w', newline='') as dumpFile:
+            if not path.lower().endswith('.csv'):
+                json.dump(report, dumpFile, indent=2)
+                return
+            writer = csv.writer(dumpFile)
+            writer.writerow(['kind', 'name', 'calls', 'totalMs', 'meanMs',
+                             'p50Ms', 'p95Ms', 'maxMs'])
+            for (name, summary) in report['spans'].items():
+                writer.writerow(['span', name] +
+                                [summary[column] for column in
+                                 ('calls', 'totalMs', 'meanMs', 'p50Ms',
+                                  'p95Ms', 'maxMs')])
+            for (name, value) in report['counters'].items():
+                writer.writerow(['counter', name, value])
+
+class CountingWindow(object):
+    """Passes everything through to a curses window or pad, counting the
+    calls as it goes"""
+    def __init__(self, window, profiler):
+        super(CountingWindow, self).__init__()
+        self.window = window
+        self.profiler = profiler
+
+    def __getattr__(self, name):
+        attribute = getattr(self.window, name)
+        if not callable(attribute):
+            return attribute
+        def counted(*args):
+            self.profiler.count('curses.calls')
+            return attribute(*args)
+        return counted
+
+class CountingBackend(object):
+    """A backend whose windows and pads count their calls"""
+    def __init__(self, backend, profiler):
+        super(CountingBackend, self).__init__()
+        self.backend = backend
+        self.profiler = profiler
+
+    def newWindow(self, height, width):
+        return CountingWindow(self.backend.newWindow(height, width), self.profiler)
+
+    def newPad(self, height, width):
+        return CountingWindow(self.backend.newPad(height, width), self.profiler)
+
+    def doupdate(self):
+        self.profiler.count('curses.calls')
+        self.backend.doupdate()
+
+    def __getattr__(self, name):
+        return getattr(self.backend, name)
+
+current = Profiler(Constants.PROFILE_HISTORY)
+current.enabled = Constants.PROFILING
+
+def enable():
+    current.enabled = True
+
+def span(name):
+    """A span to time a block with, `with profiler.span('draw'):`"""
+    return current.span(name)
+
+def count(name, amount=1):
+    current.count(name, amount)
@@ -0,0 +1,182 @@
+# Map rendering. The static layers around the screen are baked on to the
+# game pad, then each frame only repaints the cells that changed.
+
+# Python imports
+from itertools import groupby
+
+# Our imports
+from constants import Constants
+from mapgrid import MapGrid
+
+class DirtyCells(object):
+    """Map cells that need repainting from the static layers next frame.
+    Doors, moving entities and FoV changes feed in to this."""
+    def __init__(self, grid):
+        super(DirtyCells, self).__init__()
+        self.grid = grid
+        self.cells = set()
+
+    def mark(self, y, x):
+        if self.grid.inBounds(y, x):
+            self.cells.add(y * self.grid.width + x)
+
+    def markIndex(self, index):
+        self.cells.add(index)
+
+    def take(self):
+        """Returns the dirty cells and starts afresh"""
+        cells = self.cells
+        self.cells = set()
+        return cells
+
+class MapRenderer(object):
+    """Draws the map on to the game pad. The pad holds the part of the map
+    around the screen, out to RENDER_MARGIN past each edge (or all of it,
+    for a small map), so it stays the same size however big the map is.
+    That part is composed and written a row at a time (one addstr per
+    colour run) when it's baked, which happens again whenever the screen
+    moves off it. In between, each frame repaints the dirty cells and draws
+    the entities under the camera on top."""
+    def __init__(self, game):
+        super(MapRenderer, self).__init__()
+        self.game = game
+        self.alwaysSeeWalls = False
+        self.baked = False
+        # Cells that multi-character entity glyphs spilled in to last frame
+        self.spillCells = []
+        # The map cell at the top left of the pad, and how much it holds
+        self.top = 0
+        self.left = 0
+        grid = game.grid
+        self.height = min(grid.height, Constants.GAMEHEIGHT + 2 * Constants.RENDER_MARGIN)
+        self.width = min(grid.width, Constants.GAMEWIDTH + 2 * Constants.RENDER_MARGIN)
+
+    def padSize(self):
+        """(height, width) the game pad needs to be. +1 height because of a
+        crazy off-the-screen cursor bug."""
+        return (self.height + 1, self.width)
+
+    def cellGlyph(self, index):
+        """The (character, colour) that the map shows at the index,
+        ignoring entities, or None if nothing is drawn there"""
+        grid = self.game.grid
+        vision = grid.vision[index]
+        terrain = grid.terrain[index]
+        visible = vision & MapGrid.VISIBLE or not Constants.FOV_ENABLED
+
+        # Walls go over everything
+        if terrain & MapGrid.WALL:
+            if ((vision & MapGrid.SEEN and (self.alwaysSeeWalls or visible))
+                or not Constants.FOV_ENABLED):
+                return grid.glyphs[grid.wallGlyphs[index]]
+
+        if not visible:
+            return None
+        if terrain & MapGrid.DOOR:
+            door = grid.doorAt(index)
+            return (door.character, door.colour)
+        if terrain & MapGrid.FENCE:
+            return grid.glyphs[grid.fenceGlyphs[index]]
+        if terrain & MapGrid.DECORATION:
+            return grid.glyphs[grid.decorationGlyphs[index]]
+        return ('.', Constants.COLOUR_GREEN)
+
+    def staticGlyph(self, index):
+        """The single character and colour shown in the cell. House number
+        signs can be two characters, the second of which only shows if
+        nothing is drawn to the right of the sign."""
+        cell = self.cellGlyph(index)
+        if cell is None:
+            if index % self.game.grid.width > 0:
+                left = self.cellGlyph(index - 1)
+                if left is not None and len(left[0]) > 1:
+                    return (left[0][1], left[1])
+            return (' ', Constants.COLOUR_WHITE)
+        return (cell[0][0], cell[1])
+
+    def bakeRow(self, pad, y):
+        """Compose one row of the static map and write it run by run"""
+        grid = self.game.grid
+        base = y * grid.width + self.left
+        cells = [self.staticGlyph(index)
+                 for index in range(base, base + self.width)]
+        x = 0
+        for (colour, run) in groupby(cells, key=lambda cell: cell[1]):
+            text = ''.join(character for (character, _) in run)
+            pad.addstr(y - self.top, x, text, colour)
+            x += len(text)
+
+    def bake(self, pad, top, left, height, width):
+        """Paint the static layers on to the pad, for the part of the map
+        around the window with its top left corner at (top, left)"""
+        grid = self.game.grid
+        margin = Constants.RENDER_MARGIN
+        self.top = max(0, min(top - margin, grid.height - self.height))
+        self.left = max(0, min(left - margin, grid.width - self.width))
+        for y in range(self.top, self.top + self.height):
+            self.bakeRow(pad, y)
+        self.game.dirtyCells.take()
+        self.spillCells = []
+        self.baked = True
+
+    def covers(self, top, left, height, width):
+        """True if the pad holds the whole of the window"""
+        return (self.top <= top and top + height <= self.top + self.height and
+                self.left <= left and left + width <= self.left + self.width)
+
+    def repaint(self, pad, index):
+        """Paint a single cell from the static layers, if the pad holds it"""
+        (y, x) = divmod(index, self.game.grid.width)
+        if not (self.top <= y < self.top + self.height and
+                self.left <= x < self.left + self.width):
+            return
+        (character, colour) = self.staticGlyph(index)
+        pad.addstr(y - self.top, x - self.left, character, colour)
+
+    def entityGlyphs(self, top, left, height, width):
+        """List of (y, x, character, colour) for every entity in the
+        window, in the order they should be drawn"""
+        game = self.game
+        grid = game.grid
+        glyphs = []
+        for npc in game.npcs:
+            if not (top <= npc.y < top + height and left <= npc.x < left + width):
+                continue
+            if grid.isVisible(npc.y, npc.x) or not Constants.FOV_ENABLED:
+                if (npc in game.villagers and
+                    game.player.notebook.isNpcKnown(npc) and
+                    npc.alive):
+                    character = str(npc.square.house.number)
+                else:
+                    character = npc.character
+                glyphs.append((npc.y, npc.x, character, npc.colour))
+        player = game.player
+        glyphs.append((player.y, player.x, player.character, player.colour))
+        return glyphs
+
+    def draw(self, pad, top, left, height, width):
+        """Bring the pad up to date and draw the entities in the window with
+        its top left corner at (top, left)"""
+        grid = self.game.grid
+        if not self.baked or not self.covers(top, left, height, width):
+            self.bake(pad, top, left, height, width)
+        else:
+            dirty = self.game.dirtyCells.take()
+            dirty.update(self.spillCells)
+            for index in dirty:
+                self.repaint(pad, index)
+                # A sign's second digit lives in the next cell along
+                if (index % grid.width < grid.width - 1 and
+                    grid.terrain[index] & MapGrid.WALL and
+                    len(grid.glyphs[grid.wallGlyphs[index]][0]) > 1):
+                    self.repaint(pad, index + 1)
+
+        # Entities go on top, house numbers spilling over to the right. The
+        # spilt cells get restored next frame.
+        self.spillCells = []
+        for (y, x, character, colour) in self.entityGlyphs(top, left,
+                                                           height, width):
+            character = character[:left + width - x]
+            pad.addstr(y - self.top, x - self.left, character, colour)
+            for offset in range(1, len(character)):
+                self.spillCells.append(y * grid.width + x + offset)
@@ -0,0 +1,73 @@
+# Recording and replaying input. A recording is the master seed the game
+# was started with, whether routes were found on a process pool (they come
+# out differently to the ones found in the game loop) and every key it
+# read, which is enough to play the same game again without a terminal and
+# end up in exactly the same place.
+
+# Python imports
+import hashlib, json, struct
+
+# Our imports
+from constants import Constants
+import rng
+
+class ReplayFinished(Exception):
+    """Raised when a replay runs out of keys"""
+    pass
+
+class Recording(object):
+    """The seed a game started from, its pathfinding workers and the keys
+    that were pressed"""
+    def __init__(self, seed, workers=0, keys=None):
+        super(Recording, self).__init__()
+        self.seed = seed
+        self.workers = workers
+        self.keys = keys if keys is not None else []
+
+    def save(self, path):
+        with open(path, 'w') as recordingFile:
+            json.dump({'seed': self.seed, 'workers': self.workers,
+                       'keys': self.keys}, recordingFile)
+
+    @staticmethod
+    def load(path):
+        with open(path) as recordingFile:
+            data = json.load(recordingFile)
+        return Recording(data['seed'], data.get('workers', 0), data['keys'])
+
+class InputRecorder(object):
+    """Writes down every key the game reads"""
+    def __init__(self):
+        super(InputRecorder, self).__init__()
+        self.recording = Recording(rng.masterSeed,
+                                   Constants.PATHFINDING_WORKERS)
+
+    def record(self, key):
+        self.recording.keys.append(key)
+
+class InputReplayer(object):
+    """Hands the game the keys from a recording, one at a time"""
+    def __init__(self, recording):
+        super(InputReplayer, self).__init__()
+        self.keys = recording.keys
+        self.position = 0
+
+    def nextKey(self):
+        if self.position >= len(self.keys):
+            raise ReplayFinished()
+        key = self.keys[self.position]
+        self.position += 1
+        return key
+
+def stateDigest(game):
+    """A hash of the map, everyone's positions and the clock, for checking
+    two runs ended up in the same place"""
+    digest = hashlib.sha1()
+    grid = game.grid
+    for layer in (grid.terrain, grid.passable, grid.vision):
+        digest.update(bytes(layer))
+    entities = [game.player] + game.npcs
+    for entity in entities:
+        digest.update(struct.pack('<ii', entity.y, entity.x))
+    digest.update(struct.pack('<iii', game.hour, game.minute, game.turn))
+    return digest.hexdigest()
@@ -0,0 +1,45 @@
+# Random numbers. Everything random in the game draws from one of a few
+# named streams, each seeded from a single master seed, so a run can be
+# repeated exactly and one part of the game drawing more numbers doesn't
+# shift what another gets.
+
+# Python imports
+import random
+
+# The streams, by what they're used for
+STREAMS = ('generation', 'ai', 'combat', 'names')
+
+generation = random.Random() # Building the world and setting up the murder
+ai = random.Random()         # NPC behaviour
+combat = random.Random()     # Kicking doors and the like
+names = random.Random()      # Names and looks for new people
+
+masterSeed = None
+
+def seed(value=None):
+    """Reseed every stream from the master seed, or a fresh one if there
+    isn't one. The streams are reseeded in place, so anything holding on to
+    one carries on working. Returns the master seed."""
+    global masterSeed
+    if value is None:
+        value = random.SystemRandom().getrandbits(32)
+    masterSeed = value
+    for name in STREAMS:
+        stream(name).seed("{}:{}".format(value, name))
+    return value
+
+def stream(name):
+    """The stream with the given name"""
+    if name not in STREAMS:
+        raise KeyError(name)
+    return globals()[name]
+
+def getState():
+    """The state of every stream, by name"""
+    return dict((name, stream(name).getstate()) for name in STREAMS)
+
+def setState(state):
+    for (name, streamState) in state.items():
+        stream(name).setstate(streamState)
+
+seed()
@@ -0,0 +1,525 @@
+# Saving and loading games. A save file is a small header and section
+# table, followed by the map layers as packed arrays (each starting on a
+# page boundary, so the file can be memory-mapped) and then everything
+# else in a compact tagged encoding.
+
+# Python imports
+import mmap, struct, sys
+from array import array
+
+# Our imports
+from constants import Constants
+from tiles import Door
+from mapgrid import MapGrid
+from chunks import ChunkedLayer
+from town import Town, House
+from entity import NPC, Police
+from plan import Plan
+from pathfinding import TownGraph, PathRequest
+import behaviours, rng
+
+MAGIC = b'RDSV'
+VERSION = 6
+PAGE = mmap.ALLOCATIONGRANULARITY
+
+# magic, version, number of sections, map height, map width
+HEADER = struct.Struct('<4sHHII')
+# name, array typecode, offset, length in bytes
+SECTION = struct.Struct('<16scQQ')
+
+# The sections holding the town graph's routes, every step of every edge,
+# and the routes in the path cache
+ROUTES = 'routes'
+CACHED_ROUTES = 'cachedRoutes'
+
+# The grid layers that get saved as they are. Passability, opacity and
+# vision are saved too so nothing needs recalculating, not even the field
+# of view, but occupancy comes back as the entities are put on the map.
+LAYERS = ['terrain', 'passable', 'opaque', 'vision', 'wallGlyphs',
+          'fenceGlyphs', 'decorationGlyphs', 'doorIndex']
+
+COLOURS = ['WHITE', 'RED', 'YELLOW', 'GREEN', 'BLUE']
+
+##### The encoding for everything that isn't a map layer
+
+INT = struct.Struct('<q')
+FLOAT = struct.Struct('<d')
+COUNT = struct.Struct('<I')
+
+def encode(value, out):
+    """Appends the encoding of value to the list of byte strings out.
+    Handles None, bools, ints, floats, strings, lists/tuples and dicts with
+    string keys, which is all the game state needs."""
+    if value is None:
+        out.append(b'N')
+    elif value is True:
+        out.append(b'T')
+    elif value is False:
+        out.append(b'F')
+    elif isinstance(value, int):
+        out.append(b'i' + INT.pack(value))
+    elif isinstance(value, float):
+        out.append(b'f' + FLOAT.pack(value))
+    elif isinstance(value, str):
+        data = value.encode('utf-8')
+        out.append(b's' + COUNT.pack(len(data)) + data)
+    elif isinstance(value, (list, tuple)):
+        out.append(b'l' + COUNT.pack(len(value)))
+        for item in value:
+            encode(item, out)
+    elif isinstance(value, dict):
+        out.append(b'd' + COUNT.pack(len(value)))
+        for (key, item) in value.items():
+            encode(key, out)
+            encode(item, out)
+    else:
+        raise TypeError("Can't save a {}".format(type(value).__name__))
+
+def decode(buffer, offset=0):
+    """Reads one value from the buffer at offset. Returns the value and the
+    offset just past it. Lists and tuples both come back as lists."""
+    tag = buffer[offset:offset + 1]
+    offset += 1
+    if tag == b'N':
+        return (None, offset)
+    if tag == b'T':
+        return (True, offset)
+    if tag == b'F':
+        return (False, offset)
+    if tag == b'i':
+        return (INT.unpack_from(buffer, offset)[0], offset + INT.size)
+    if tag == b'f':
+        return (FLOAT.unpack_from(buffer, offset)[0], offset + FLOAT.size)
+    if tag not in (b's', b'l', b'd'):
+        raise ValueError("Corrupt save file")
+    (count,) = COUNT.unpack_from(buffer, offset)
+    offset += COUNT.size
+    if tag == b's':
+        return (buffer[offset:offset + count].decode('utf-8'), offset + count)
+    if tag == b'l':
+        items = []
+        for _ in range(count):
+            (item, offset) = decode(buffer, offset)
+            items.append(item)
+        return (items, offset)
+    items = dict()
+    for _ in range(count):
+        (key, offset) = decode(buffer, offset)
+        (items[key], offset) = decode(buffer, offset)
+    return (items, offset)
+
+def colourName(colour):
+    """Colours are saved by name, since their values depend on the backend"""
+    if colour is None:
+        return None
+    for name in COLOURS:
+        if getattr(Constants, 'COLOUR_' + name) == colour:
+            return name
+    return 'WHITE'
+
+def colourValue(name):
+    if name is None:
+        return None
+    return getattr(Constants, 'COLOUR_' + name)
+
+##### Saving
+
+def behaviourState(behaviour, squares):
+    """A behaviour as [name, index of the house's square or None]"""
+    if isinstance(behaviour, behaviours.VisitingHouse):
+        for (index, square) in enumerate(squares):
+            if square.house is behaviour.house:
+                return ['VisitingHouse', index]
+    return [type(behaviour).__name__, None]
+
+def npcState(game, npc):
+    squares = game.squares
+    entries = []
+    for ((hour, minute), entry) in sorted(npc.plan.planEntries.items()):
+        if isinstance(entry, Plan.VisitNeighbour):
+            entries.append([hour, minute, squares.index(entry.square),
+                            entry.shouldReschedule, list(entry.rescheduleTime)])
+    return {
+        'police': isinstance(npc, Police),
+        'position': [npc.y, npc.x],
+        'square': squares.index(npc.square) if npc.square in squares else None,
+        'names': [npc.firstName, npc.lastName],
+        'gender': npc.gender,
+        'looks': [npc.eyeColour, npc.hairColour, npc.description],
+        'glyph': [npc.character, colourName(npc.colour)],
+        'alive': npc.alive,
+        'killer': npc.killer,
+        'moods': [npc.scared, npc.answeringDoor],
+        'path': [list(step) for step in npc.path] if npc.path else npc.path,
+        'turnsBlocked': npc.turnsBlocked,
+        'lastUpdateTurn': npc.lastUpdateTurn,
+        'behaviour': behaviourState(npc.currentBehaviour, squares),
+        'plan': entries,
+    }
+
+def flattenPath(path, routes):
+    """Appends the steps of path to the flat array of y, x pairs routes,
+    returning how many steps there were"""
+    for step in path:
+        routes.extend(step)
+    return len(path)
+
+def townGraphState(game):
+    """The town graph's nodes and edges, plus the steps along every edge
+    as one flat array of y, x pairs"""
+    graph = game.pathFinder.townGraph
+    routes = array('i')
+    links = [[first, second, flattenPath(graph.segments[(first, second)], routes)]
+             for (first, second) in graph.links]
+    built = [square.house for square in game.squares]
+    houses = [[built.index(house), node] for (house, node) in graph.houses]
+    state = {
+        'nodes': [list(node) for node in graph.nodes],
+        'links': links,
+        'houses': houses,
+    }
+    return (state, routes)
+
+def requestState(game, request):
+    """A path request as [NPC, start, goal, behaviour or None]"""
+    behaviour = request.behaviour
+    if behaviour is not None:
+        behaviour = behaviourState(behaviour, game.squares)
+    return [game.npcs.index(request.npc), list(request.start),
+            list(request.goal), behaviour]
+
+def pathRequestsState(game):
+    """The routes NPCs are waiting on, in the order they're queued. Ones
+    that have been superseded are left out, since they'd only be skipped.
+    The path cache goes with them, since whether a route's cached decides
+    how soon it's handed over. Its routes go in a flat array of y, x
+    pairs."""
+    requests = game.pathRequests
+    def live(request):
+        return request.npc.pathRequest is request
+    cache = game.pathFinder.cache
+    routes = array('i')
+    state = {
+        'ticks': requests.ticks,
+        'waiting': [requestState(game, request)
+                    for request in requests.waiting if live(request)],
+        'running': [[due, requestState(game, request)]
+                    for (due, request, _) in requests.running if live(request)],
+        'ready': [[requestState(game, request),
+                   [list(step) for step in path] if path else path]
+                  for (request, path) in requests.ready if live(request)],
+        'cache': [[list(start), list(goal), flattenPath(path, routes)]
+                  for ((start, goal), path) in cache.paths.items()],
+    }
+    return (state, routes)
+
+def gameState(game):
+    """Everything apart from the map layers, as plain values"""
+    grid = game.grid
+    npcs = game.npcs
+    doors = [None if door is None else
+             [door.y, door.x, door.closed, door.locked, door.character,
+              door.closeTurn]
+             for door in grid.doorTable[1:]]
+    houses = []
+    for square in game.squares:
+        house = square.house
+        houses.append([house.number, house.height, house.width,
+                       house.absoluteY, house.absoluteX,
+                       list(house.frontDoorPos),
+                       [[room.y, room.x, room.height, room.width]
+                        for room in house.rooms],
+                       square.houseYOffset, square.houseXOffset,
+                       [house.layoutAttempts, house.partitionRestarts,
+                        house.doorsPunched]])
+    notebook = game.player.notebook
+    return {
+        'clock': [game.hour, game.minute, game.turnsToNextMinute, game.turn],
+        'glyphs': [[character, colourName(colour)]
+                   for (character, colour) in grid.glyphs],
+        'doors': doors,
+        'towns': [[town.y, town.x, town.height, town.width]
+                  for town in game.towns],
+        'houses': houses,
+        'npcs': [npcState(game, npc) for npc in npcs],
+        'player': [game.player.y, game.player.x],
+        'notebook': [[npcs.index(npc) for npc in notebook.knownNpcs],
+                     list(notebook.knownActivities)],
+        'murder': [npcs.index(game.victim), npcs.index(game.killer)],
+        'statusLine': game.statusLine,
+        'random': dict((name, [version, list(internal), gauss])
+                       for (name, (version, internal, gauss))
+                       in rng.getState().items()),
+    }
+
+def layerBytes(layer):
+    """A layer's contents, little-endian whatever the platform"""
+    if isinstance(layer, ChunkedLayer):
+        layer = layer.flat()
+    if isinstance(layer, array) and layer.itemsize > 1 and sys.byteorder == 'big':
+        layer = array(layer.typecode, layer)
+        layer.byteswap()
+    return bytes(layer)
+
+def saveGame(game, path):
+    """Writes the game to path"""
+    grid = game.grid
+    sections = []
+    for name in LAYERS:
+        layer = getattr(grid, name)
+        typecode = getattr(layer, 'typecode', 'B')
+        sections.append((name, typecode, layerBytes(layer)))
+    state = gameState(game)
+    (state['townGraph'], routes) = townGraphState(game)
+    sections.append((ROUTES, 'i', layerBytes(routes)))
+    (state['pathRequests'], cachedRoutes) = pathRequestsState(game)
+    sections.append((CACHED_ROUTES, 'i', layerBytes(cachedRoutes)))
+    encoded = []
+    encode(state, encoded)
+    sections.append(('state', 'B', b''.join(encoded)))
+
+    # Lay the sections out on page boundaries after the header
+    offset = HEADER.size + SECTION.size * len(sections)
+    table = []
+    for (name, typecode, data) in sections:
+        offset += -offset % PAGE
+        table.append((name, typecode, offset, data))
+        offset += len(data)
+
+    with open(path, 'wb') as saveFile:
+        saveFile.write(HEADER.pack(MAGIC, VERSION, len(sections),
+                                   grid.height, grid.width))
+        for (name, typecode, offset, data) in table:
+            saveFile.write(SECTION.pack(name.encode('ascii'),
+                                        typecode.encode('ascii'),
+                                        offset, len(data)))
+        for (name, typecode, offset, data) in table:
+            saveFile.write(b'\0' * (offset - saveFile.tell()))
+            saveFile.write(data)
+
+##### Loading
+
+def readSections(buffer):
+    """The section table, as name -> (typecode, offset, length)"""
+    (magic, version, count, height, width) = HEADER.unpack_from(buffer, 0)
+    if magic != MAGIC:
+        raise ValueError("Not a save file")
+    if version != VERSION:
+        raise ValueError("Unsupported save version {}".format(version))
+    sections = dict()
+    for index in range(count):
+        (name, typecode, offset, length) = SECTION.unpack_from(
+            buffer, HEADER.size + SECTION.size * index)
+        sections[name.rstrip(b'\0').decode('ascii')] = (
+            typecode.decode('ascii'), offset, length)
+    return (height, width, sections)
+
+def loadLayers(grid, buffer, sections):
+    """Copy the map layers out of the (mapped) save file in to the grid.
+    Returns the cells that were in the player's view."""
+    for name in LAYERS:
+        (typecode, offset, length) = sections[name]
+        data = buffer[offset:offset + length]
+        if typecode == 'B':
+            layer = bytearray(data)
+        else:
+            layer = array(typecode)
+            layer.frombytes(data)
+            if sys.byteorder == 'big':
+                layer.byteswap()
+        if len(layer) != grid.height * grid.width:
+            raise ValueError("Save file layer {} is the wrong size".format(name))
+        if name == 'vision':
+            lit = visibleCells(layer)
+        grid.loadLayer(name, layer)
+    return lit
+
+def visibleCells(layer):
+    """Flat indices of the cells marked visible in a vision layer"""
+    marks = bytes(layer).translate(
+        bytes(1 if value & MapGrid.VISIBLE else 0 for value in range(256)))
+    cells = []
+    index = marks.find(1)
+    while index != -1:
+        cells.append(index)
+        index = marks.find(1, index + 1)
+    return frozenset(cells)
+
+def readArray(buffer, sections, name):
+    """A section of the save file that isn't a map layer, as an array"""
+    (typecode, offset, length) = sections[name]
+    values = array(typecode)
+    values.frombytes(buffer[offset:offset + length])
+    if sys.byteorder == 'big':
+        values.byteswap()
+    return values
+
+def unflattenPaths(routes, lengths):
+    """Splits a flat array of y, x pairs back up in to paths of the given
+    lengths"""
+    paths = []
+    offset = 0
+    for length in lengths:
+        steps = routes[offset:offset + length * 2]
+        paths.append(list(zip(steps[0::2], steps[1::2])))
+        offset += length * 2
+    return paths
+
+def loadPathRequests(game, state, routes):
+    """Put the path cache and the queues of path requests back just as
+    they were, rather than asking for the routes all over again"""
+    cache = game.pathFinder.cache
+    paths = unflattenPaths(routes, [length for (_, _, length) in state['cache']])
+    for ((start, goal, _), path) in zip(state['cache'], paths):
+        cache.store(tuple(start), tuple(goal), path)
+
+    def request(saved):
+        (npcIndex, start, goal, behaviour) = saved
+        npc = game.npcs[npcIndex]
+        if behaviour is not None:
+            behaviour = behaviourFromState(npc, behaviour, game.squares)
+        newRequest = PathRequest(npc, tuple(start), tuple(goal), behaviour)
+        npc.pathRequest = newRequest
+        return newRequest
+    requests = game.pathRequests
+    requests.ticks = state['ticks']
+    for saved in state['waiting']:
+        requests.waiting.append(request(saved))
+    for (due, saved) in state['running']:
+        requests.resubmit(request(saved), due)
+    for (saved, path) in state['ready']:
+        requests.ready.append((request(saved),
+                               [tuple(step) for step in path] if path else path))
+
+def loadTownGraph(game, state, routes):
+    """Put the town graph back together from its saved nodes and edges,
+    without finding any of the routes again"""
+    graph = TownGraph(game.grid)
+    for (y, x) in state['nodes']:
+        graph.node((y, x))
+    paths = unflattenPaths(routes, [length for (_, _, length) in state['links']])
+    for ((first, second, _), path) in zip(state['links'], paths):
+        graph.addEdge(first, second, path)
+    graph.houses = [(game.squares[square].house, node)
+                    for (square, node) in state['houses']]
+    game.pathFinder.townGraph = graph
+
+def behaviourFromState(npc, state, squares):
+    (name, squareIndex) = state
+    if name == 'VisitingHouse':
+        return behaviours.VisitingHouse(npc, squares[squareIndex].house)
+    if name == 'Dead':
+        return behaviours.Dead(npc)
+    return behaviours.DefaultBehaviour(npc)
+
+def loadNpc(game, state):
+    (y, x) = state['position']
+    npc = (Police if state['police'] else NPC)(game, y, x)
+    if state['square'] is not None:
+        npc.square = game.squares[state['square']]
+        npc.square.npc = npc
+    (npc.firstName, npc.lastName) = state['names']
+    npc.gender = state['gender']
+    (npc.eyeColour, npc.hairColour, npc.description) = state['looks']
+    npc.character = state['glyph'][0]
+    npc.colour = colourValue(state['glyph'][1])
+    npc.alive = state['alive']
+    npc.killer = state['killer']
+    (npc.scared, npc.answeringDoor) = state['moods']
+    path = state['path']
+    npc.path = [tuple(step) for step in path] if path else path
+    npc.turnsBlocked = state['turnsBlocked']
+    npc.lastUpdateTurn = state['lastUpdateTurn']
+    return npc
+
+def loadGame(game, path):
+    """Fills in a freshly constructed Game from the save file at path,
+    instead of generating a new world"""
+    grid = game.grid
+    with open(path, 'rb') as saveFile:
+        with mmap.mmap(saveFile.fileno(), 0, access=mmap.ACCESS_READ) as buffer:
+            (height, width, sections) = readSections(buffer)
+            if (height, width) != (grid.height, grid.width):
+                raise ValueError("Save file is for a {}x{} map".format(width, height))
+            (_, offset, length) = sections['state']
+            (state, _) = decode(buffer[offset:offset + length])
+
+            # The towns only lay out their squares, the roads are already
+            # in the saved map layers
+            game.towns = [Town(game, y, x, townHeight, townWidth)
+                          for (y, x, townHeight, townWidth) in state['towns']]
+            lit = loadLayers(grid, buffer, sections)
+            routes = readArray(buffer, sections, ROUTES)
+            cachedRoutes = readArray(buffer, sections, CACHED_ROUTES)
+
+    grid.glyphs = [(character, colourValue(colour))
+                   for (character, colour) in state['glyphs']]
+    grid.glyphIndices = dict((glyph, index)
+                             for (index, glyph) in enumerate(grid.glyphs))
+    grid.doorTable = [None]
+    for door in state['doors']:
+        if door is None:
+            grid.doorTable.append(None)
+            continue
+        (y, x, closed, locked, character, closeTurn) = door
+        newDoor = Door(game, y, x)
+        (newDoor.closed, newDoor.locked) = (closed, locked)
+        newDoor.character = character
+        newDoor.closeTurn = closeTurn
+        grid.doorTable.append(newDoor)
+
+    (game.hour, game.minute, game.turnsToNextMinute, game.turn) = state['clock']
+    for door in grid.doorTable[1:]:
+        if door is not None and not door.closed and door.closeTurn >= game.turn:
+            game.doorTimers.schedule(door.closeTurn, door)
+
+    # Houses, in the order their squares were built
+    squares = [town.squares[key] for town in game.towns
+               for key in sorted(town.squares)]
+    for (square, house) in zip(squares, state['houses']):
+        newHouse = House(game)
+        (newHouse.number, newHouse.height, newHouse.width,
+         newHouse.absoluteY, newHouse.absoluteX) = house[:5]
+        newHouse.frontDoorPos = tuple(house[5])
+        newHouse.rooms = [House.Room(y, x, roomHeight, roomWidth)
+                          for (y, x, roomHeight, roomWidth) in house[6]]
+        (square.houseYOffset, square.houseXOffset) = house[7:9]
+        (newHouse.layoutAttempts, newHouse.partitionRestarts,
+         newHouse.doorsPunched) = house[9]
+        square.house = newHouse
+        game.squares.append(square)
+
+    # Then the people in them
+    for saved in state['npcs']:
+        npc = loadNpc(game, saved)
+        game.npcs.append(npc)
+        if npc.square is not None:
+            game.villagers.append(npc)
+        if isinstance(npc, Police):
+            game.police.append(npc)
+    (victim, killer) = state['murder']
+    (game.victim, game.killer) = (game.npcs[victim], game.npcs[killer])
+    for (npc, saved) in zip(game.npcs, state['npcs']):
+        npc.currentBehaviour = behaviourFromState(npc, saved['behaviour'],
+                                                  game.squares)
+        for (hour, minute, squareIndex, reschedule, later) in saved['plan']:
+            entry = Plan.VisitNeighbour(npc, game.squares[squareIndex])
+            entry.shouldReschedule = reschedule
+            entry.rescheduleTime = tuple(later)
+            npc.plan.addPlanEntry(hour, minute, entry)
+
+    player = game.player
+    player.setPosition(*state['player'])
+    (known, activities) = state['notebook']
+    player.notebook.knownNpcs = [game.npcs[index] for index in known]
+    player.notebook.knownActivities = activities
+    game.statusLine = state['statusLine']
+
+    loadTownGraph(game, state['townGraph'], routes)
+    loadPathRequests(game, state['pathRequests'], cachedRoutes)
+    player.fov.restore(player.y, player.x, lit)
+
+    # Carry on with the same random numbers we would have had
+    rng.setState(dict((name, (version, tuple(internal), gauss))
+                      for (name, (version, internal, gauss))
+                      in state['random'].items()))
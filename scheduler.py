@@ -0,0 +1,97 @@
+# Scheduling. Things that should happen at a given time go in to a timer
+# wheel, so the game only looks at what's due instead of polling everything.
+
+# Our imports
+from constants import Constants
+
+class TimerWheel(object):
+    """A ring of slots, each holding the items due at that time. Times wrap
+    around the number of slots, so anything scheduled must be due within one
+    revolution of the wheel. Slots are dicts used as ordered sets, so busy
+    ones (the top of the hour) don't slow down scheduling."""
+    def __init__(self, slots):
+        super(TimerWheel, self).__init__()
+        self.slots = [dict() for _ in range(slots)]
+
+    def schedule(self, time, item):
+        # Anything already in the slot keeps its place
+        self.slots[time % len(self.slots)].setdefault(item)
+
+    def take(self, time):
+        """Removes and returns everything in the slot for the given time, in
+        the order it was scheduled"""
+        index = time % len(self.slots)
+        due = list(self.slots[index])
+        self.slots[index] = dict()
+        return due
+
+    def __len__(self):
+        return sum(len(slot) for slot in self.slots)
+
+class PlanScheduler(object):
+    """Owns the timing of every NPC's Plan. Plans register with a wheel with
+    a slot per minute of the day, and when the clock ticks over only the
+    Plans with an entry for the new minute are run."""
+    MINUTES_PER_DAY = 24 * 60
+
+    def __init__(self):
+        super(PlanScheduler, self).__init__()
+        self.wheel = TimerWheel(PlanScheduler.MINUTES_PER_DAY)
+
+    def schedule(self, plan, hour, minute):
+        """The plan has an entry due at hour:minute"""
+        self.wheel.schedule(hour * 60 + minute, plan)
+
+    def dispatch(self, hour, minute):
+        """Run every plan entry due at hour:minute"""
+        for plan in self.wheel.take(hour * 60 + minute):
+            if plan.npc.alive:
+                plan.executePlanEntry(hour, minute)
+
+class DetailScheduler(object):
+    """Decides how closely each NPC is simulated. Anyone on the screen, or
+    within margin of its edges, gets a full update every turn. Everyone
+    further away is only updated every interval turns, taking it in turns so
+    the work is spread out, and catches up on all the turns since their last
+    update at once. NPCs that come near the screen catch up before their
+    first full update, so they're where they would have been. The margin is
+    kept wider than interval, so nobody's seen making a catch-up move."""
+    def __init__(self, game, margin, interval):
+        super(DetailScheduler, self).__init__()
+        self.game = game
+        self.margin = max(margin, interval + 1)
+        self.interval = interval
+        self.fullUpdates = 0 # NPC updates done turn by turn
+        self.coarseUpdates = 0 # NPC updates covering several turns
+
+    def window(self):
+        """(top, left, bottom, right) of the area simulated in full, the
+        camera as it'll be drawn plus the margin all round"""
+        player = self.game.player
+        (top, left) = self.game.cameraFor(player.y, player.x)
+        margin = self.margin
+        return (top - margin, left - margin,
+                top + Constants.GAMEHEIGHT + margin,
+                left + Constants.GAMEWIDTH + margin)
+
+    def isNear(self, npc, window=None):
+        (top, left, bottom, right) = window or self.window()
+        return top <= npc.y < bottom and left <= npc.x < right
+
+    def update(self, turn):
+        """Update whichever NPCs are due this turn"""
+        window = self.window()
+        for (slot, npc) in enumerate(self.game.npcs):
+            if self.isNear(npc, window):
+                owed = turn - npc.lastUpdateTurn - 1
+                if owed > 0:
+                    npc.coarseUpdate(owed)
+                    self.coarseUpdates += 1
+                npc.update()
+                self.fullUpdates += 1
+            elif (turn + slot) % self.interval == 0:
+                npc.coarseUpdate(turn - npc.lastUpdateTurn)
+                self.coarseUpdates += 1
+            else:
+                continue
+            npc.lastUpdateTurn = turn
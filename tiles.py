@@ -7,12 +7,29 @@ from constants import Constants
 class Tile(object):
     """Represents a tile in vision.
     Once seen, a tile will show what is currently on it via the game draw method.
-    Once a tile goes out of view, everything that isn't a wall disappears during draw."""
-    def __init__(self):
-        self.visible = False
-        self.seen = False
-        if not Constants.FOV_ENABLED:
-            self.seen = True
+    Once a tile goes out of view, everything that isn't a wall disappears during draw.
+    Tiles are just views on to the vision layer of the MapGrid."""
+    # Vision layer flags
+    VISIBLE = 1
+    SEEN = 2
+
+    def __init__(self, grid, index):
+        self.grid = grid
+        self.index = index
+
+    def getFlag(self, flag):
+        return bool(self.grid.vision[self.index] & flag)
+
+    def setFlag(self, flag, value):
+        if value:
+            self.grid.vision[self.index] |= flag
+        else:
+            self.grid.vision[self.index] &= ~flag
+
+    visible = property(lambda self: self.getFlag(Tile.VISIBLE),
+                       lambda self, value: self.setFlag(Tile.VISIBLE, value))
+    seen = property(lambda self: self.getFlag(Tile.SEEN),
+                    lambda self, value: self.setFlag(Tile.SEEN, value))
 
 class Decoration(object):
     """Just a decorative tile."""
@@ -36,17 +53,15 @@ class Door(object):
         self.locked = False
         self.colour = Constants.COLOUR_RED
         self.game = game
-        self.timer = -1
+        self.closeTurn = -1 # The turn an open door swings shut
 
-    def update(self):
-        if self.timer == 0:
+    def update(self, turn):
+        """Called by the game's door timers on the turn we're due to close"""
+        if turn == self.closeTurn:
             # Close the door if it's open.
             if not self.closed:
                 self.open() # This function could be named better
 
-        if self.timer >= 0:
-            self.timer -= 1
-
     def npcOpen(self): # NPCs share all their house keys, okay?
         self.open()
 
@@ -68,12 +83,12 @@ class Door(object):
         self.closed = not self.closed
         self.character = '+' if self.closed else '-'
         if not self.closed:
-            self.timer = Constants.DOOR_CLOSE_TIME
-            try:
-                self.game.walls[(self.y, self.x-1)] # Ridiculous test for wall on the left
+            self.closeTurn = self.game.turn + Constants.DOOR_CLOSE_TIME
+            self.game.doorTimers.schedule(self.closeTurn, self)
+            if (self.y, self.x-1) in self.game.walls: # Test for wall on the left
                 self.character = '|'
-            except:
-                pass
+        self.game.grid.doorChanged(self)
+        self.game.dirtyCells.mark(self.y, self.x)
 
 class Wall(object):
     """Wall objects, which the player cannot walk through"""
@@ -1,8 +1,5 @@
 # The title screen
 
-# External imports
-import curses
-
 # Our imports
 from game import Game
 from constants import Constants
@@ -33,14 +30,18 @@ titleScreenGraphics = """
 
 class TitleScreen:
     """The title screen representation"""
-    def __init__(self, screen):
+    def __init__(self, screen, backend, savePath = None, recorder = None):
         """Just set up the text, really"""
         self.screen = screen
+        self.backend = backend
+        self.savePath = savePath
+        self.recorder = recorder
 
     def execute(self):
         self.screen.addstr(0, 0, titleScreenGraphics, Constants.COLOUR_WHITE)
         self.screen.noutrefresh()
-        curses.doupdate()
+        self.backend.doupdate()
         self.screen.getch()
-        game = Game(self.screen)
+        game = Game(self.screen, self.backend, self.savePath)
+        game.recorder = self.recorder
         game.mainLoop()
@@ -2,11 +2,15 @@
 
 # Python imports
 import random
+from collections import deque
+from concurrent.futures import ProcessPoolExecutor
 
 # Our imports
 from tiles import Wall, Door, Decoration, Fence
 from constants import Constants
 from entity import NPC
+from pathfinding import DistanceField
+import rng
 
 class Town(object):
     """A grid with random edges removed, houses placed on the grid"""
@@ -40,38 +44,32 @@ class Town(object):
                    and (self.y + Town.GRID_SIZE -1, x + self.x) not in self.game.doors:
                     self.game.fences[(self.y + Town.GRID_SIZE - 1, x + self.x)] = Fence()
 
-        def generateHouse(self):
-            """Actually builds the house and fences"""
-            # Generate the building
+        def buildHouse(self, layout):
+            """Actually builds the house and fences, from a layout made by
+            layoutHouse"""
             house = House(self.game)
             self.house = house
-            self.house.number = len(self.game.villagers) + 1
-            house.generateLayout(Town.GRID_SIZE, Town.GRID_SIZE)
+            house.applyLayout(layout)
             yOffset = Town.GRID_SIZE - house.height - 1
-            xSpace = Town.GRID_SIZE - house.width - 1
-            xOffset = random.randint(0, xSpace)
+            xOffset = layout['xOffset']
             house.createHouse(self.y + yOffset, self.x + xOffset)
             self.houseYOffset = yOffset
             self.houseXOffset = xOffset
 
             self.generateFences()
 
-            # NPC owners! Woohoo! Spawn them inside the house, but not in a wall
-            npcYOffset = 0
-            npcXOffset = 0
-            while (self.y + yOffset + npcYOffset, self.x + xOffset + npcXOffset) in self.game.walls:
-                npcYOffset = random.randint(1, house.height - 2)
-                npcXOffset = random.randint(1, house.width - 2)
+            # NPC owners! Woohoo!
+            (npcYOffset, npcXOffset) = layout['spawn']
             newNpc = NPC(self.game,
                          self.y + yOffset + npcYOffset,
                          self.x + xOffset + npcXOffset)
             newNpc.square = self
             self.npc = newNpc
-            
+
             self.game.villagers.append(newNpc)
             self.game.npcs.append(newNpc)
 
-        # Finally, add it to the list of squares
+            # Finally, add it to the list of squares
             self.game.squares.append(self)
 
     def __init__(self, game, y, x, height, width):
@@ -92,7 +90,8 @@ class Town(object):
             self.game.decorations[(self.y + y1), (self.x + x1)] = self.roads[y1, x1]
 
     def generateRoads(self):
-        """Create roads for given grid square"""
+        """Work out where the roads go. They're put on the map by
+        createRoads, once the world's being generated."""
         for y in range(self.height):
             for x in range(self.width):
                 square = self.squares[(y,x)]
@@ -109,18 +108,16 @@ class Town(object):
                 for roadX in range(Town.GRID_SIZE + Town.ROAD_HEIGHT):
                     for width in range(Town.ROAD_HEIGHT):
                         self.roads[(baseY + Town.GRID_SIZE + width, baseX + roadX)] = road
-        self.createRoads()
 
     def generateGrid(self):
-        """Generate the grids + roads + houses"""
+        """Generate the grids + roads. The roads and houses go on the map
+        afterwards, in generateTowns."""
         for y in range(self.height):
             squareY = y * (Town.GRID_SIZE + Town.ROAD_HEIGHT) + self.y
             for x in range(self.width):
                 squareX = x * (Town.GRID_SIZE + Town.ROAD_WIDTH) + self.x
                 # Make a square
                 self.squares[(y,x)] = Town.Square(self.game, squareY, squareX)
-                # For now, put a house in the square
-                self.squares[(y,x)].generateHouse()
         self.generateRoads()
 
 class Building(object):
@@ -138,6 +135,7 @@ class Building(object):
             self.height = height
             self.width = width
             self.walls = dict()
+            self.field = None # Distance field to the room, once it's wanted
             self.generateWalls()
 
         def generateWalls(self):
@@ -148,7 +146,7 @@ class Building(object):
                 self.walls[(y, 0)] = Wall()
                 self.walls[(y, self.width)] = Wall()
 
-    def __init__(self, game):
+    def __init__(self, game, stream=None):
         self.absoluteX = 0
         self.absoluteY = 0
         self.width = 0
@@ -158,9 +156,19 @@ class Building(object):
         self.decorations = dict()
         self.doors = dict()
         self.frontDoorPos = (0, 0)
+        self.doorField = None # Distance field to the front door, once it's wanted
         self.minNumberOfRooms = 1
         self.maxNumberOfRooms = 4
         self.game = game
+        # Layouts draw from their own stream when they're given one, so
+        # they come out the same wherever they're generated
+        self.random = stream if stream is not None else rng.generation
+        self.placedDoors = [] # (y, x, locked) once the doors are settled
+
+        # How much work the layout took, for measuring generation
+        self.layoutAttempts = 0 # Layouts generated, including the final one
+        self.partitionRestarts = 0 # Times partitioning had to start over
+        self.doorsPunched = 0 # Doors added to make the layout connected
 
     def generateLayout(self, maxHeight, maxWidth):
         # Create the outer walls
@@ -168,22 +176,26 @@ class Building(object):
 
         # Create rooms
         self.generateRooms()
+        self.layoutAttempts += 1
 
-        # If the house isn't fully navigable, regenerate it until it is
-        while not self.floodFill():
+        # If the house isn't fully navigable, put in doors until it is. If
+        # that's not possible, start again.
+        while not self.repairLayout():
             del self.rooms[:]
             self.doors.clear()
             self.walls.clear()
             self.generateWalls(maxHeight, maxWidth)
             self.generateRooms()
+            self.layoutAttempts += 1
 
         # Create doors
         self.generateDoors()
+        self.placeDoors()
 
     def generateWalls(self, maxHeight, maxWidth):
         """Create the outer walls of the house"""
-        self.width = random.randint(House.MINIMUM_WIDTH, maxWidth) - 1
-        self.height = random.randint(House.MINIMUM_WIDTH, maxHeight) - 1
+        self.width = self.random.randint(House.MINIMUM_WIDTH, maxWidth) - 1
+        self.height = self.random.randint(House.MINIMUM_WIDTH, maxHeight) - 1
         for x in range(self.width):
             self.walls[(0, x)] = Wall()
             self.walls[(self.height, x)] = Wall()
@@ -199,58 +211,89 @@ class Building(object):
 
     def generateFirstPartition(self):
         # Make the initial rooms via the first partition
-        widthwisePartition = bool(random.getrandbits(1))
-        cut = random.randint(House.MINIMUM_ROOM_DIMENSION,
+        widthwisePartition = bool(self.random.getrandbits(1))
+        cut = self.random.randint(House.MINIMUM_ROOM_DIMENSION,
                             (self.height if widthwisePartition else self.width) - House.MINIMUM_ROOM_DIMENSION)
         if widthwisePartition:
             room = House.Room(0, 0, cut, self.width)
             self.rooms.append(room)
             room = House.Room(cut, 0, self.height - cut, self.width)
             self.rooms.append(room)
-            doorPos = random.randint(0, self.width - 1)
+            doorPos = self.random.randint(0, self.width - 1)
             self.doors[(cut, doorPos)] = Door(self.game, cut, doorPos)
         else:
             room = House.Room(0, 0, self.height, cut)
             self.rooms.append(room)
             room = House.Room(0, cut, self.height, self.width - cut)
             self.rooms.append(room)
-            doorPos = random.randint(1, self.height - 1)
+            doorPos = self.random.randint(1, self.height - 1)
             self.doors[(doorPos, cut)] = Door(self.game, doorPos, cut)
 
-    def floodFill(self):
-        """Returns true if every square of the house is reachable from the top-left space"""
-        def _floodFill(y, x, visited):
-            if x >= 0 and x < self.width and y >= 0 and y < self.height:
-                if visited[(y,x)]:
-                    return
-
-                visited[(y,x)] = True
-                _floodFill(y-1, x, visited)
-                _floodFill(y, x-1, visited)
-                _floodFill(y+1, x, visited)
-                _floodFill(y, x+1, visited)
-
-        visited = {}
-
-        for y in range(self.height):
-            for x in range(self.width):
-                visited[(y,x)] = False
-                if ((y, x) in self.walls) and ((y, x) not in self.doors):
-                    visited[(y,x)] = True
-
-        _floodFill(1, 1, visited)
-
-        for y in range(self.height):
-            for x in range(self.width):
-                if not visited[(y,x)]:
-                    return False
-
-        return True
+    def blockedCells(self):
+        """Compact grid of the house, one byte per cell, set where there's
+        a wall without a door in it"""
+        blocked = bytearray(self.height * self.width)
+        for (y, x) in self.walls:
+            if 0 <= y < self.height and 0 <= x < self.width and (y, x) not in self.doors:
+                blocked[y * self.width + x] = 1
+        return blocked
+
+    def reachableCells(self, blocked):
+        """Breadth first search from the top-left space. Returns a grid the
+        same shape as blocked, set for every cell that can be reached (and
+        for the walls, which don't need reaching)."""
+        width = self.width
+        visited = bytearray(blocked)
+        start = width + 1
+        if visited[start]:
+            return visited
+        visited[start] = 1
+        frontier = deque([start])
+        while frontier:
+            current = frontier.popleft()
+            (y, x) = divmod(current, width)
+            for (neighbour, nY, nX) in ((current - width, y - 1, x),
+                                        (current - 1, y, x - 1),
+                                        (current + width, y + 1, x),
+                                        (current + 1, y, x + 1)):
+                if 0 <= nY < self.height and 0 <= nX < width and not visited[neighbour]:
+                    visited[neighbour] = 1
+                    frontier.append(neighbour)
+        return visited
+
+    def repairLayout(self):
+        """Punch doors through walls until every square of the house can be
+        reached. Returns False if there's nowhere to put one."""
+        width = self.width
+        while True:
+            blocked = self.blockedCells()
+            visited = self.reachableCells(blocked)
+            if all(visited):
+                return True
+
+            # Look for a straight bit of wall with somewhere we can reach on
+            # one side and somewhere we can't on the other
+            candidates = []
+            for y in range(1, self.height - 1):
+                for x in range(1, width - 1):
+                    index = y * width + x
+                    if not blocked[index]:
+                        continue
+                    for (a, b, c, d) in ((index - width, index + width, index - 1, index + 1),
+                                         (index - 1, index + 1, index - width, index + width)):
+                        if (blocked[c] and blocked[d] and not blocked[a] and
+                            not blocked[b] and visited[a] != visited[b]):
+                            candidates.append((y, x))
+            if not candidates:
+                return False
+            (y, x) = self.random.choice(candidates)
+            self.doors[(y, x)] = Door(self.game, y, x)
+            self.doorsPunched += 1
 
     def generateRooms(self):
         """Create the rooms by repeated partitioning"""
         # How many partitions should we make, excluding the first?
-        numPartitions = random.randint(self.minNumberOfRooms, self.maxNumberOfRooms) - 1
+        numPartitions = self.random.randint(self.minNumberOfRooms, self.maxNumberOfRooms) - 1
         if numPartitions > 0:
             self.generateFirstPartition()
             numPartitions -= 1
@@ -261,24 +304,25 @@ class Building(object):
         for _ in range(numPartitions):
             # Get a random room, which we'll partition just like the first room
             attempts = 10
-            baseRoom = random.choice(self.rooms)
-            widthwisePartition = bool(random.getrandbits(1))
+            baseRoom = self.random.choice(self.rooms)
+            widthwisePartition = bool(self.random.getrandbits(1))
 
             # Make sure the room will be able to split. If not, pick a new room up to 10 times.
             while baseRoom.height < (2 * House.MINIMUM_ROOM_DIMENSION) or baseRoom.width < (2 * House.MINIMUM_ROOM_DIMENSION):
                 # If we really can't make it work with the rooms we have, start fresh.
                 if attempts < 0:
                     attempts = 10
+                    self.partitionRestarts += 1
                     del self.rooms[:]
                     self.doors.clear()
                     self.generateFirstPartition()
 
-                randomRoomIndex = random.randint(0, len(self.rooms) - 1)
+                randomRoomIndex = self.random.randint(0, len(self.rooms) - 1)
                 baseRoom = self.rooms[randomRoomIndex]
-                widthwisePartition = bool(random.getrandbits(1))
+                widthwisePartition = bool(self.random.getrandbits(1))
                 attempts -= 1
 
-            cut = random.randint(House.MINIMUM_ROOM_DIMENSION,
+            cut = self.random.randint(House.MINIMUM_ROOM_DIMENSION,
                                  (baseRoom.height if widthwisePartition else baseRoom.width) - House.MINIMUM_ROOM_DIMENSION)
 
             # Create the two rooms and put a door in connecting the two new rooms
@@ -287,14 +331,14 @@ class Building(object):
                 self.rooms.append(room)
                 room = House.Room(baseRoom.y + cut, baseRoom.x, baseRoom.height - cut, baseRoom.width)
                 self.rooms.append(room)
-                doorPos = random.randint(baseRoom.x+1, baseRoom.x + baseRoom.width - 1)
+                doorPos = self.random.randint(baseRoom.x+1, baseRoom.x + baseRoom.width - 1)
                 self.doors[(baseRoom.y + cut, doorPos)] = Door(self.game, baseRoom.y + cut, doorPos)
             else:
                 room = House.Room(baseRoom.y, baseRoom.x, baseRoom.height, cut)
                 self.rooms.append(room)
                 room = House.Room(baseRoom.y, baseRoom.x + cut, baseRoom.height, baseRoom.width  - cut)
                 self.rooms.append(room)
-                doorPos = random.randint(baseRoom.y+1, baseRoom.y + baseRoom.height - 1)
+                doorPos = self.random.randint(baseRoom.y+1, baseRoom.y + baseRoom.height - 1)
                 self.doors[(doorPos, baseRoom.x + cut)] = Door(self.game, doorPos, baseRoom.x + cut)
 
             # Remove the original room, because it's now two rooms.
@@ -308,7 +352,7 @@ class Building(object):
     def generateFrontDoor(self):
         """Create the front door"""
         # Actual door creation
-        doorX = random.randint(1,self.width-1)
+        doorX = self.random.randint(1,self.width-1)
         if (self.height-1, doorX) in self.walls:
             doorX -= 1
         self.doors[(self.height, doorX)] = Door(self.game, self.height, doorX)
@@ -324,6 +368,67 @@ class Building(object):
         """Make the doors for the house"""
         self.generateFrontDoor()
 
+    def placeDoors(self):
+        """Settle where the doors actually go, knocking out the walls under
+        them. Only looks at the house's own walls, so it can happen before
+        the house is anywhere near the map."""
+        del self.placedDoors[:]
+        walls = self.walls
+        for (y, x) in self.doors:
+            # If it rests at an intersection of three walls, move the door.
+            # This is the ugliest line in history. Along with the other condition.
+            (oY, oX) = (y, x)
+            if ((y-1, x) in walls and (y+1, x) in walls) and ((y, x+1) in walls or (y, x-1) in walls):
+                y -= 1
+            elif ((y, x-1) in walls and (y, x+1) in walls) and ((y+1, x) in walls or (y-1, x) in walls):
+                x -= 1
+            # Remove any walls that happen to be hanging around where they shouldn't be
+            walls.pop((y, x), None)
+            self.placedDoors.append((y, x, self.doors[(oY, oX)].locked))
+
+    def layout(self):
+        """The finished layout as plain data, for handing between processes"""
+        (signY, signX) = (self.frontDoorPos[0], self.frontDoorPos[1] - 1)
+        return {
+            'number': self.number,
+            'height': self.height,
+            'width': self.width,
+            'rooms': [(room.y, room.x, room.height, room.width)
+                      for room in self.rooms],
+            'walls': list(self.walls),
+            'floors': list(self.decorations),
+            'doors': list(self.placedDoors),
+            'frontDoorPos': self.frontDoorPos,
+            'sign': (signY, signX) if (signY, signX) in self.walls else None,
+            'layoutAttempts': self.layoutAttempts,
+            'partitionRestarts': self.partitionRestarts,
+            'doorsPunched': self.doorsPunched,
+        }
+
+    def applyLayout(self, layout):
+        """Take on a layout made by layout(), possibly in another process"""
+        self.number = layout['number']
+        self.height = layout['height']
+        self.width = layout['width']
+        self.rooms = [House.Room(y, x, height, width)
+                      for (y, x, height, width) in layout['rooms']]
+        self.walls = dict((position, Wall()) for position in layout['walls'])
+        self.decorations = dict()
+        for position in layout['floors']:
+            decoration = Decoration()
+            decoration.character = '.'
+            decoration.colour = Constants.COLOUR_WHITE
+            self.decorations[position] = decoration
+        self.placedDoors = list(layout['doors'])
+        self.frontDoorPos = layout['frontDoorPos']
+        if layout['sign'] is not None:
+            sign = self.walls[layout['sign']]
+            sign.character = str(self.number)
+            sign.colour = Constants.COLOUR_GREEN
+        self.layoutAttempts = layout['layoutAttempts']
+        self.partitionRestarts = layout['partitionRestarts']
+        self.doorsPunched = layout['doorsPunched']
+
     def createHouse(self, y, x):
         """Actually builds the house, regardless of if it fits or not"""
         self.absoluteX = x
@@ -337,25 +442,67 @@ class Building(object):
             self.game.decorations[(y+y1), (x+x1)] = self.decorations[y1, x1]
 
         # Doors..
-        for (y1, x1) in self.doors:
-            # If it rests at an intersection of three walls, move the door.
-            # This is the ugliest line in history. Along with the other condition.
-            (oY, oX) = (y1, x1)
-            if ((y + y1-1, x + x1) in self.game.walls and (y + y1+1, x + x1) in self.game.walls) and ((y + y1, x + x1+1) in self.game.walls or (y + y1, x + x1-1) in self.game.walls):
-                y1 -= 1
-            elif ((y + y1, x + x1-1) in self.game.walls and (y + y1, x + x1+1) in self.game.walls) and  ((y + y1+1, x + x1) in self.game.walls or (y + y1-1, x + x1) in self.game.walls):
-                x1 -= 1
-            # Remove any walls that happen to be hanging around where they shouldn't be
-            try:
-                wall = self.game.walls[(y + y1, x + x1)]
-                del self.game.walls[(y + y1, x + x1)]
-            except:
-                # No wall!
-                pass
+        for (y1, x1, locked) in self.placedDoors:
             door = Door(self.game, y1 + y, x1 + x)
-            door.locked = self.doors[(oY, oX)].locked
+            door.locked = locked
             self.game.doors[(y1 + y, x1 + x)] = door
 
+    def fieldTo(self, goals):
+        """Distance field covering the whole house, to the goal cells. Only
+        the doors can change once the house is built, and those don't block
+        the pathfinding anyway."""
+        grid = self.game.grid
+        return DistanceField(grid.terrain, grid.width,
+                             self.absoluteY, self.absoluteX,
+                             self.height + 1, self.width + 1, goals)
+
+    def frontDoorField(self):
+        """Distance field to the front door, worked out the first time
+        anyone needs it"""
+        if self.doorField is None:
+            self.doorField = self.fieldTo([self.frontDoor()])
+        return self.doorField
+
+    def roomField(self, room):
+        """Distance field to anywhere inside the room, worked out the first
+        time anyone needs it"""
+        if room.field is None:
+            top = self.absoluteY + room.y
+            left = self.absoluteX + room.x
+            room.field = self.fieldTo([(top + y, left + x)
+                                       for y in range(1, room.height)
+                                       for x in range(1, room.width)])
+        return room.field
+
+    def frontDoor(self):
+        """Map position of the front door"""
+        return (self.absoluteY + self.frontDoorPos[0],
+                self.absoluteX + self.frontDoorPos[1])
+
+    def contains(self, y, x):
+        """Is (y, x) within the house's walls (or on them)?"""
+        return (self.absoluteY <= y <= self.absoluteY + self.height and
+                self.absoluteX <= x <= self.absoluteX + self.width)
+
+    def pathInRoom(self, room, start, goal):
+        """Route from start to goal, a cell inside the room, read from the
+        room's distance field. Returns None if start isn't somewhere in the
+        house the field reaches, so the pathfinder has to do it instead."""
+        path = self.roomField(room).pathFrom(start[0], start[1])
+        if not path:
+            return None
+
+        # Rooms are open rectangles, so once we're in just walk to the goal
+        (y, x) = path[-1]
+        (goalY, goalX) = goal
+        while x != goalX:
+            x += 1 if goalX > x else -1
+            path.append((y, x))
+        while y != goalY:
+            y += 1 if goalY > y else -1
+            path.append((y, x))
+        return path
+
     def area(self):
         """Returns the total area required to place house."""
         return self.width * self.height
@@ -363,7 +510,56 @@ class Building(object):
 
 class House(Building):
     """Houses are procedurally generated constructs in which NPCs live."""
-    def __init__(self, game):
-        super(House, self).__init__(game)
+    def __init__(self, game, stream=None):
+        super(House, self).__init__(game, stream)
+
+def layoutHouse(seed, number):
+    """Lays out a house for a town square, along with where it sits in the
+    square and where its owner starts. Everything comes from a stream
+    seeded with seed, and the result is plain data, so this can run in any
+    process and still come out the same."""
+    stream = random.Random(seed)
+    house = House(None, stream)
+    house.number = number
+    house.generateLayout(Town.GRID_SIZE, Town.GRID_SIZE)
+    layout = house.layout()
+
+    xSpace = Town.GRID_SIZE - house.width - 1
+    layout['xOffset'] = stream.randint(0, xSpace)
+
+    # Spawn the owner inside the house, but not in a wall
+    (npcYOffset, npcXOffset) = (0, 0)
+    while (npcYOffset, npcXOffset) in house.walls:
+        npcYOffset = stream.randint(1, house.height - 2)
+        npcXOffset = stream.randint(1, house.width - 2)
+    layout['spawn'] = (npcYOffset, npcXOffset)
+    return layout
+
+def townSites(height, width, rows, columns):
+    """Top left corners for towns of rows by columns squares, as many as
+    fit on a map of the given size, TOWN_SPACING apart"""
+    townHeight = rows * (Town.GRID_SIZE + Town.ROAD_HEIGHT)
+    townWidth = columns * (Town.GRID_SIZE + Town.ROAD_WIDTH)
+    return [(y, x)
+            for y in range(5, height - townHeight + 1, Constants.TOWN_SPACING)
+            for x in range(5, width - townWidth + 1, Constants.TOWN_SPACING)]
+
+def generateTowns(game, towns):
+    """Puts down the roads and builds the houses in every town. The layouts are made first, in a
+    process pool if Constants.GENERATION_WORKERS says so, each from its own
+    seed drawn in order here. They're then put on the map one by one, so
+    the world is the same however many workers there are."""
+    for town in towns:
+        town.createRoads()
+    squares = [town.squares[key] for town in towns for key in sorted(town.squares)]
+    seeds = [rng.generation.getrandbits(32) for _ in squares]
+    numbers = [len(game.villagers) + 1 + index for index in range(len(squares))]
+    if Constants.GENERATION_WORKERS > 0:
+        with ProcessPoolExecutor(max_workers=Constants.GENERATION_WORKERS) as pool:
+            layouts = list(pool.map(layoutHouse, seeds, numbers))
+    else:
+        layouts = list(map(layoutHouse, seeds, numbers))
+    for (square, layout) in zip(squares, layouts):
+        square.buildHouse(layout)
 
 